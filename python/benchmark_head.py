@@ -0,0 +1,70 @@
+"""
+Benchmark P4Repo.head() against a single `p4 changes -m1 //client/...` query
+
+Runs against the test fixture server by default, or an existing server with --port.
+Large stream views show the biggest difference, e.g.
+    python benchmark_head.py --port ssl:perforce:1666 --stream //depot/main
+"""
+import os
+import time
+import argparse
+import tempfile
+import contextlib
+
+from perforce import P4Repo
+from test_perforce import find_free_port, run_p4d
+
+
+def timed(func, iterations):
+    """Run func repeatedly, returning its result and the mean duration"""
+    start = time.time()
+    for _ in range(iterations):
+        result = func()
+    return result, (time.time() - start) / iterations
+
+
+def benchmark(repo, iterations):
+    """Compare head resolution strategies for a repo"""
+    repo.head() # Create client before timing
+    legacy, legacy_seconds = timed(
+        lambda: '@' + repo.head_at_revision('//%s/...' % repo.perforce.client), iterations)
+    resolved, resolved_seconds = timed(repo.head, iterations)
+    assert legacy == resolved, "head() returned %s, expected %s" % (resolved, legacy)
+    print('%-40s %10s %12.1fms %12.1fms %8.2fx' % (
+        repo.stream or ' '.join(repo.view), resolved, legacy_seconds * 1000, resolved_seconds * 1000,
+        legacy_seconds / resolved_seconds))
+
+
+def main():
+    """Run the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', help='P4PORT of an existing server, defaults to the test fixture')
+    parser.add_argument('--stream', action='append', default=[], help='Stream to benchmark')
+    parser.add_argument('--view', action='append', default=[], help='View mapping to benchmark')
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        if args.port:
+            os.environ['P4PORT'] = args.port
+        else:
+            port = 'ssl:localhost:%s' % find_free_port()
+            os.environ['P4PORT'] = port
+            stack.enter_context(run_p4d(port, from_zip='server.zip'))
+            time.sleep(1)
+            args.stream = args.stream or ['//stream-depot/main', '//stream-depot/dev']
+            args.view = args.view or ['//depot/... depot/...', '//stream-depot/dev/... dev/...']
+
+        print('%-40s %10s %14s %14s %9s' % ('workspace', 'head', 'changes -m1', 'head()', 'speedup'))
+        for stream in args.stream:
+            root = stack.enter_context(tempfile.TemporaryDirectory(prefix='bk-p4-bench-'))
+            with P4Repo(root=root, stream=stream) as repo:
+                benchmark(repo, args.iterations)
+        if args.view:
+            root = stack.enter_context(tempfile.TemporaryDirectory(prefix='bk-p4-bench-'))
+            with P4Repo(root=root, view=args.view) as repo:
+                benchmark(repo, args.iterations)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,9 @@ import subprocess
 import re
 from datetime import datetime
 
-__ACCESS_TOKEN__ = os.environ['BUILDKITE_AGENT_ACCESS_TOKEN']
+__ACCESS_TOKEN__ = os.environ.get('BUILDKITE_AGENT_ACCESS_TOKEN')
 # https://github.com/buildkite/cli/blob/e8aac4bedf34cd8084a3ae7a4ab7812c611d0310/local/run.go#L403
-__LOCAL_RUN__ = os.environ['BUILDKITE_AGENT_NAME'] == 'local'
+__LOCAL_RUN__ = os.environ.get('BUILDKITE_AGENT_NAME') == 'local'
 
 __REVISION_METADATA__ = 'buildkite-perforce-revision'
 __REVISION_METADATA_DEPRECATED__ = 'buildkite:perforce:revision' # old metadata key, incompatible with `bk local run`
@@ -51,6 +51,15 @@ def get_config():
     conf['client_options'] = os.environ.get('BUILDKITE_PLUGIN_PERFORCE_CLIENT_OPTIONS')
     conf['client_type'] = os.environ.get('BUILDKITE_PLUGIN_PERFORCE_CLIENT_TYPE')
     conf['fingerprint'] = list_from_env_array('BUILDKITE_PLUGIN_PERFORCE_FINGERPRINT')
+    conf['track'] = os.environ.get('BUILDKITE_PLUGIN_PERFORCE_TRACK') == 'true'
+    conf['priority'] = list_from_env_array('BUILDKITE_PLUGIN_PERFORCE_PRIORITY')
+    conf['replica'] = os.environ.get('BUILDKITE_PLUGIN_PERFORCE_REPLICA')
+    conf['replica_fingerprint'] = os.environ.get('BUILDKITE_PLUGIN_PERFORCE_REPLICA_FINGERPRINT')
+    conf['bootstrap'] = os.environ.get('BUILDKITE_PLUGIN_PERFORCE_BOOTSTRAP') or 0
+    conf['bandwidth'] = os.environ.get('BUILDKITE_PLUGIN_PERFORCE_BANDWIDTH')
+    # Workspaces shared by several agents on a host belong to the host
+    conf['host_client'] = get_shared_workspace() and \
+        int(os.environ.get('BUILDKITE_AGENT_META_DATA_AGENT_COUNT') or 1) > 1
 
     if 'BUILDKITE_PLUGIN_PERFORCE_ROOT' in os.environ and not __LOCAL_RUN__:
         raise Exception("Custom P4 root is for use in unit tests only")
@@ -63,6 +72,28 @@ def get_config():
     conf['view'] = ['%s %s' % (v, next(view_iter)) for v in view_iter]
     return conf
 
+def get_checkout_mode():
+    """How much of a checkout to run: 'sync' for a full checkout, or 'metadata' to only resolve the revision"""
+    mode = os.environ.get('BUILDKITE_PLUGIN_PERFORCE_MODE') or 'sync'
+    if mode not in ('sync', 'metadata'):
+        raise Exception("Unknown checkout mode %s, expected sync or metadata" % mode)
+    return mode
+
+def get_background_sync():
+    """Whether to sync paths after the priority paths in the background, while the build runs"""
+    return os.environ.get('BUILDKITE_PLUGIN_PERFORCE_BACKGROUND_SYNC') == 'true'
+
+def get_shared_workspace():
+    """Whether the workspace is shared with other pipelines and agents, see hooks/pre-checkout"""
+    return os.environ.get('BUILDKITE_PLUGIN_PERFORCE_SHARE_WORKSPACE') == 'true'
+
+def set_checkout_path(path):
+    """Tell the checkout hook where the workspace was checked out, if it moved"""
+    path_file = os.environ.get('PERFORCE_CHECKOUT_PATH_FILE')
+    if path_file:
+        with open(path_file, 'w') as outfile:
+            outfile.write(path)
+
 def get_metadata(key):
     """If it exists, retrieve metadata from buildkite for a given key"""
     if not __ACCESS_TOKEN__:
@@ -84,17 +115,22 @@ def set_metadata(key, value, overwrite=False):
         subprocess.call(['buildkite-agent', 'meta-data', 'set',  key, value])
         return True
 
-def get_users_changelist():
-    """Get the shelved changelist supplied by the user, if applicable"""
-    # Overrides the CL to unshelve via plugin config
+def get_users_changelists():
+    """Get the shelved changelists supplied by the user, if applicable
+
+    Several changelists may be given for stacked reviews, from bottom to top.
+    """
+    # Overrides the CLs to unshelve via plugin config
     # TODO: Remove this to discourage git-based pipelines that sync perforce
-    shelved_cl = os.environ.get('BUILDKITE_PLUGIN_PERFORCE_SHELVED_CHANGE')
-    if shelved_cl:
-        return shelved_cl
+    shelved_cls = list_from_env_array('BUILDKITE_PLUGIN_PERFORCE_SHELVED_CHANGE')
+    if shelved_cls:
+        return [cl for value in shelved_cls for cl in re.split(r'[\s,]+', value) if cl]
 
     branch = os.environ.get('BUILDKITE_BRANCH', '')
-    if branch.isdigit():
-        return branch
+    branch_cls = branch.split(',')
+    if all(cl.isdigit() for cl in branch_cls):
+        return branch_cls
+    return []
 
 def get_build_revision():
     """Get a p4 revision for the build from buildkite context"""
@@ -2,36 +2,191 @@
 Entrypoint for checkout hook
 """
 import os
+import time
+import sqlite3
 import argparse
-import subprocess
+import contextlib
 
-from perforce import P4Repo
+from perforce import P4Repo, get_logger
+from history import CheckoutHistory
+from workspace import (WorkspaceLock, WorkspaceBusy, mark_job, mark_ready, wait_exclusive, seed_overlay,
+    prune_overlays, start_background_sync)
 from buildkite import (get_env, get_config, get_build_revision, set_build_revision,
-    get_users_changelist, set_build_info)
+    get_users_changelists, set_build_info, get_background_sync, get_shared_workspace, set_checkout_path,
+    get_checkout_mode)
 
-def main():
-    """Main"""
+# How long a job which must change a shared workspace waits for other jobs, before using a private overlay
+__SHARED_WAIT_SECONDS__ = 60
+
+def open_history():
+    """Open the checkout history database, if this agent has one"""
+    try:
+        return CheckoutHistory.open_default()
+    except sqlite3.Error as ex:
+        print("Checkout history unavailable: %s" % ex)
+        return None
+
+def overlay_config(config, overlay):
+    """Configuration for an agent's private overlay of the shared workspace in config"""
+    return dict(config, root=overlay, host_client=False)
+
+def finish_sync(revision, root=None):
+    """Entrypoint for the background sync started by a checkout with priority paths"""
     os.environ.update(get_env())
     config = get_config()
+    if root and os.path.abspath(root) != os.path.abspath(config['root']):
+        config = overlay_config(config, root) # The checkout used this agent's overlay
+    with P4Repo(**config) as repo, WorkspaceLock(repo.root):
+        try:
+            repo.finish_sync(revision)
+        except Exception as ex:
+            mark_ready(repo.root, '//...', error=str(ex)) # Stop builds waiting on paths which will never arrive
+            raise
 
-    repo = P4Repo(**config)
+def run_checkout(repo, history, revision, user_changelists, background_sync=False, on_head=None,
+                 shared=False, shared_timeout=__SHARED_WAIT_SECONDS__):
+    """Sync the workspace to revision and apply the users shelved changes
 
-    revision = get_build_revision()
-    if revision is None:
-        revision = repo.head()
-        set_build_revision(revision)
+    Resolves head when revision is None, calling on_head with it before syncing.
+    With shared, jobs which need the workspace exactly as it is use it together, while a job which
+    must change it waits for them to finish, raising WorkspaceBusy if they are still running after
+    shared_timeout seconds.
+    Returns (revision, description, deferred), where deferred means the rest of the workspace
+    must still be synced in the background after the priority paths.
+    """
+    start = time.time()
+    phases = {}
+
+    # Wait for background processes to stop changing the workspace, then keep them out until pre-exit
+    lock = WorkspaceLock(repo.root)
+    lock.acquire()
+    job_id = os.environ.get('BUILDKITE_JOB_ID')
+
+    success = False
+    try:
+        if revision is None:
+            phase_start = time.time()
+            # Setting up the client could change files under other jobs sharing the workspace
+            revision = repo.head_without_client() if shared else repo.head()
+            phases['head_seconds'] = time.time() - phase_start
+            if on_head:
+                on_head(revision)
+
+        if shared and not user_changelists and repo.at_revision(revision):
+            repo.perforce.logger.info("workspace is already at %s, sharing it with other jobs" % revision)
+            if job_id:
+                mark_job(repo.root, job_id)
+            description = repo.description(repo.head_at_revision(revision))
+            success = True
+            return revision, description, False
+
+        if shared and not wait_exclusive(repo.root, job_id, shared_timeout):
+            raise WorkspaceBusy("workspace %s is still in use by other jobs" % repo.root)
+        if job_id:
+            mark_job(repo.root, job_id)
+
+        # Unshelved files would be overwritten by paths synced later, so only defer without shelves
+        defer = bool(repo.priority) and background_sync and not user_changelists
+        repo.sync(revision=revision, defer=defer)
 
-    repo.sync(revision=revision)
+        if user_changelists:
+            phase_start = time.time()
+            repo.p4print_unshelve(user_changelists)
+            phases['unshelve_seconds'] = time.time() - phase_start
 
-    user_changelist = get_users_changelist()
-    if user_changelist:
-        repo.p4print_unshelve(user_changelist)
+        description = repo.description(
+            # Prefer description of the users topmost change over latest submitted change
+            user_changelists[-1] if user_changelists else repo.head_at_revision(revision)
+        )
+        success = True
+        return revision, description, defer
+    finally:
+        lock.release()
+        outcome = dict(repo.sync_stats, **phases)
+        outcome['total_seconds'] = time.time() - start
+        # Accessing repo.perforce would try to connect again after failing to connect
+        logger = get_logger()
+        logger.info("Checkout summary: %s" % ', '.join(
+            '%s=%s' % (key, round(value, 2) if isinstance(value, float) else value)
+            for key, value in sorted(outcome.items())))
+        if repo.tracking:
+            logger.info("Server performance tracking: %s" % repo.tracking.summary())
+        if history:
+            try:
+                history.record(workspace=repo.history_key(), success=success,
+                               client=repo.perforce.client if repo.connected() else None, **outcome)
+            except sqlite3.Error as ex:
+                logger.warning("Failed to record checkout history: %s" % ex)
 
+def checkout_metadata(repo, revision, user_changelists, on_head=None):
+    """Resolve the revision and description for a build without creating or syncing a client
+
+    Returns (revision, description)
+    """
+    if revision is None:
+        revision = repo.head_without_client()
+        if on_head:
+            on_head(revision)
     description = repo.description(
-        # Prefer users change description over latest submitted change
-        user_changelist or repo.head_at_revision(revision)
+        user_changelists[-1] if user_changelists else repo.head_at_revision(revision)
     )
+    return revision, description
+
+def checkout_workspace(open_repo, config, history, revision, user_changelists, background_sync=False,
+                       on_head=None, shared=False, shared_timeout=__SHARED_WAIT_SECONDS__):
+    """Check out the workspace at config['root'], or this agent's private overlay of it while it is busy
+
+    open_repo: Creates a P4Repo from config
+    Returns (revision, description, deferred, root) where root is the workspace which was checked out.
+    """
+    repo = open_repo(config)
+    try:
+        result = run_checkout(repo, history, revision, user_changelists, background_sync, on_head,
+                              shared, shared_timeout)
+        if shared:
+            prune_overlays(repo.root)
+        return result + (repo.root,)
+    except WorkspaceBusy as ex:
+        repo.perforce.logger.warning("%s, checking out a private overlay instead" % ex)
+        with WorkspaceLock(repo.root):
+            overlay = seed_overlay(repo.root, os.environ.get('BUILDKITE_AGENT_NAME', 'local'))
+        repo = open_repo(overlay_config(config, overlay))
+        result = run_checkout(repo, history, revision, user_changelists, background_sync, on_head)
+        return result + (repo.root,)
+
+def main():
+    """Main"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--finish-sync', metavar='REVISION', help='Sync the rest of the workspace after priority paths')
+    parser.add_argument('--root', help='Workspace to finish syncing, the one the checkout used')
+    args = parser.parse_args()
+    if args.finish_sync:
+        finish_sync(args.finish_sync, args.root)
+        return
+
+    os.environ.update(get_env())
+    config = get_config()
+    if get_checkout_mode() == 'metadata':
+        with P4Repo(**config) as repo:
+            revision, description = checkout_metadata(
+                repo, get_build_revision(), get_users_changelists(), on_head=set_build_revision)
+        set_build_info(revision, description)
+        return
+
+    history = open_history()
+    try:
+        with contextlib.ExitStack() as repos:
+            revision, description, deferred, root = checkout_workspace(
+                lambda config: repos.enter_context(P4Repo(history=history, **config)), config, history,
+                get_build_revision(), get_users_changelists(), background_sync=get_background_sync(),
+                on_head=set_build_revision, shared=get_shared_workspace())
+    finally:
+        if history:
+            history.close()
     set_build_info(revision, description)
+    set_checkout_path(root)
+    if deferred:
+        start_background_sync(root, revision)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,67 @@
+"""
+Entrypoint for checkout hook when a checkout_server is running on this host
+
+Buildkite metadata is read and written here, in the job, while the checkout runs in the server.
+Falls back to checking out in this process if the server is not running.
+"""
+import os
+import sys
+import json
+import socket
+
+from workspace import start_background_sync
+from buildkite import (get_env, get_config, get_build_revision, set_build_revision,
+    get_users_changelists, set_build_info, get_background_sync, get_shared_workspace, set_checkout_path,
+    get_checkout_mode)
+
+
+def request_checkout(conn, request):
+    """Send a checkout to the server and print its logs, returns the result"""
+    conn.sendall((json.dumps(request) + '\n').encode('utf-8'))
+    with conn.makefile('r', encoding='utf-8') as responses:
+        for line in responses:
+            message = json.loads(line)
+            if 'log' in message:
+                print(message['log'], flush=True)
+            elif 'head' in message:
+                set_build_revision(message['head'])
+            elif 'error' in message:
+                raise Exception("Checkout failed in checkout server:\n%s" % message['error'])
+            elif 'result' in message:
+                return message['result']
+    raise Exception("Checkout server closed the connection before the checkout finished")
+
+
+def main():
+    """Main"""
+    os.environ.update(get_env())
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(os.environ['PERFORCE_CHECKOUT_SOCKET'])
+    except OSError as ex:
+        conn.close()
+        print("Checkout server unavailable, checking out in this process: %s" % ex)
+        import checkout # pylint: disable=import-outside-toplevel
+        checkout.main()
+        return
+
+    with conn:
+        result = request_checkout(conn, {
+            'env': dict(os.environ),
+            'config': get_config(),
+            'revision': get_build_revision(),
+            'changelists': get_users_changelists(),
+            'background_sync': get_background_sync(),
+            'shared': get_shared_workspace(),
+            'mode': get_checkout_mode(),
+        })
+    set_build_info(result['revision'], result['description'])
+    if 'root' not in result:
+        return # Nothing was checked out
+    set_checkout_path(result['root'])
+    if result['deferred']:
+        start_background_sync(result['root'], result['revision'])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+Optional per-host daemon which serves checkouts with warm P4 connections and client workspaces,
+so that jobs skip starting P4Python, connecting, trusting the server and setting up the client.
+
+Each agent's checkouts run in a worker process of their own, which keeps that agent's repos warm,
+so agents on one host check out concurrently.
+
+Run one instance per agent host, e.g.
+    python checkout_server.py --socket /var/run/buildkite-perforce.sock
+and point the checkout hook at it from the agent environment hook:
+    export PERFORCE_CHECKOUT_SOCKET=/var/run/buildkite-perforce.sock
+"""
+import os
+import sys
+import json
+import logging
+import argparse
+import threading
+import traceback
+import contextlib
+import socketserver
+import multiprocessing
+
+from perforce import P4Repo
+from checkout import checkout_workspace, checkout_metadata, open_history
+
+logger = logging.getLogger("p4python")
+
+
+@contextlib.contextmanager
+def job_environment(env):
+    """Run with the environment of the job being served, which P4 and P4Repo read settings from
+
+    Only used in workers, which run one job at a time.
+    """
+    saved = dict(os.environ)
+    os.environ.clear()
+    os.environ.update(env)
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+class StreamLogs(logging.Handler):
+    """Send log lines to the job being served"""
+    def __init__(self, send):
+        logging.Handler.__init__(self)
+        self.send = send
+        self.setFormatter(logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s', '%H:%M:%S'))
+
+    def emit(self, record):
+        try:
+            self.send({'log': self.format(record)})
+        except OSError:
+            pass # Server went away, finish anyway so the workspace is left consistent
+
+
+class RepoCache:
+    """Connected repos kept between checkouts, per workspace configuration and server"""
+    def __init__(self):
+        self.repos = {} # Workspace configuration and server => P4Repo
+
+    def repo(self, config, history):
+        """Get a connected repo for a job's configuration, creating it on first use"""
+        key = json.dumps([config, os.environ.get('P4PORT'), os.environ.get('P4USER'),
+                          os.environ.get('BUILDKITE_AGENT_NAME')], sort_keys=True)
+        repo = self.repos.get(key)
+        if repo is not None and repo.connected():
+            repo.refresh()
+        else:
+            if repo is not None:
+                repo.close() # Lost its connection, start over with a fresh repo
+            repo = P4Repo(**config)
+            self.repos[key] = repo
+        repo.history = history
+        return repo
+
+    def close(self):
+        """Disconnect every repo"""
+        for repo in self.repos.values():
+            repo.close()
+        self.repos = {}
+
+
+def run_request(request, repos, send):
+    """Run one checkout for a job in its environment, sending log lines and the result"""
+    with job_environment(request['env']):
+        stream_logs = StreamLogs(send)
+        logger.addHandler(stream_logs)
+        history = open_history()
+        try:
+            if request['mode'] == 'metadata':
+                revision, description = checkout_metadata(
+                    repos.repo(request['config'], history), request['revision'], request['changelists'],
+                    on_head=lambda revision: send({'head': revision}))
+                send({'result': {'revision': revision, 'description': description}})
+                return
+            revision, description, deferred, root = checkout_workspace(
+                lambda config: repos.repo(config, history), request['config'], history,
+                request['revision'], request['changelists'], background_sync=request['background_sync'],
+                on_head=lambda revision: send({'head': revision}), shared=request['shared'])
+            send({'result': {'revision': revision, 'description': description, 'deferred': deferred, 'root': root}})
+        except Exception: # pylint: disable=broad-except
+            send({'error': traceback.format_exc()})
+        finally:
+            logger.removeHandler(stream_logs)
+            if history:
+                history.close()
+
+
+def serve_checkouts(conn):
+    """Worker process entrypoint, runs checkout requests from the server in turn until it stops"""
+    repos = RepoCache()
+    try:
+        for request in iter(conn.recv, None):
+            run_request(request, repos, conn.send)
+            conn.send(None) # Checkout finished
+    except EOFError:
+        pass # Server went away
+    finally:
+        repos.close()
+
+
+class CheckoutWorker:
+    """Process which runs the checkouts of one agent, keeping its repos warm between jobs"""
+    def __init__(self):
+        context = multiprocessing.get_context('spawn') # Forking a threaded server is unsafe
+        self.conn, worker_conn = context.Pipe()
+        self.process = context.Process(target=serve_checkouts, args=(worker_conn,), daemon=True)
+        self.process.start()
+        worker_conn.close()
+        self.lock = threading.Lock()
+
+    def checkout(self, request, send):
+        """Run a checkout in the worker, passing its messages to send until it finishes"""
+        with self.lock:
+            self.conn.send(request)
+            for message in iter(self.recv, None):
+                try:
+                    send(message)
+                except OSError:
+                    pass # Job went away, let the worker finish so the workspace is left consistent
+
+    def recv(self):
+        """Next message from the worker, None once the checkout finished"""
+        try:
+            return self.conn.recv()
+        except EOFError:
+            return {'error': 'Checkout worker exited before the checkout finished'}
+
+    def stop(self):
+        """Ask the worker to disconnect its repos and exit"""
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass # Already exited
+        self.process.join(timeout=30)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class CheckoutHandler(socketserver.StreamRequestHandler):
+    """Run one checkout for a job, streaming its logs back as JSON lines"""
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        self.server.worker(request['env'].get('BUILDKITE_AGENT_NAME', '')).checkout(request, self.send)
+
+
+class CheckoutServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves checkouts concurrently, each agent's in turn by a worker which reuses its repos"""
+    daemon_threads = True
+
+    def __init__(self, socket_path):
+        if os.path.exists(socket_path):
+            os.remove(socket_path) # Left behind by a previous server
+        socketserver.UnixStreamServer.__init__(self, socket_path, CheckoutHandler)
+        os.chmod(socket_path, 0o600) # Requests carry the job environment
+        self.workers = {} # BUILDKITE_AGENT_NAME => CheckoutWorker
+        self.workers_lock = threading.Lock()
+
+    def worker(self, agent):
+        """Get the worker for an agent, starting it on first use or if it exited"""
+        with self.workers_lock:
+            worker = self.workers.get(agent)
+            if worker is None or not worker.process.is_alive():
+                if worker is not None:
+                    worker.stop()
+                worker = CheckoutWorker()
+                self.workers[agent] = worker
+            return worker
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        with self.workers_lock:
+            for worker in self.workers.values():
+                worker.stop()
+            self.workers = {}
+
+
+def main():
+    """Run the checkout server"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', default=os.environ.get('PERFORCE_CHECKOUT_SOCKET'),
+                        help='Unix socket to listen on, defaults to $PERFORCE_CHECKOUT_SOCKET')
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error('--socket is required when PERFORCE_CHECKOUT_SOCKET is not set')
+
+    server = CheckoutServer(args.socket)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,165 @@
+"""
+Compact on-disk mirror of a client workspace have table
+"""
+import os
+import json
+import bisect
+import threading
+from array import array
+
+
+class HaveTable:
+    """Sorted, array-backed records of depot path, have revision and digest
+
+    Records are kept in three parallel arrays sorted by depot path, which
+    allows O(log n) lookups and prefix scans without asking the server.
+    Updates from sync and flush output are buffered and merged in a single
+    pass, so applying a large sync stays linear in the number of records.
+    """
+    def __init__(self, path, client=None):
+        """
+        path: File in which to persist the mirror
+        client: Name of the client workspace the mirror belongs to
+        """
+        self.path = path
+        self.client = client
+        self.complete = False # True once records are known to match the server
+        self.revision = None # Last revision synced to, if known
+        self.changed = False # True when records differ from the file on disk
+        self._depotfiles = []
+        self._revs = array('l')
+        self._digests = []
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        self._merge()
+        return len(self._depotfiles)
+
+    def load(self):
+        """Read the mirror from disk, returns False if it is missing or unusable"""
+        self.complete = False
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, 'r') as infile:
+                content = json.load(infile)
+            depotfiles = content['depotFile']
+            revs = array('l', content['rev'])
+            digests = content['digest']
+        except (ValueError, KeyError, TypeError):
+            # Corrupt mirror, e.g. a partially written file. Rebuild from the server.
+            return False
+        if content.get('client') != self.client or not len(depotfiles) == len(revs) == len(digests):
+            return False
+        self._depotfiles = depotfiles
+        self._revs = revs
+        self._digests = digests
+        self._pending = {}
+        self.revision = content.get('revision')
+        self.complete = True
+        self.changed = False
+        return True
+
+    def save(self):
+        """Atomically write the mirror to disk, unless records are missing because it was never complete"""
+        if not self.complete:
+            return
+        self._merge()
+        content = {
+            'client': self.client,
+            'revision': self.revision,
+            'depotFile': self._depotfiles,
+            'rev': self._revs.tolist(),
+            'digest': self._digests,
+        }
+        tmpfile = '%s.tmp' % self.path
+        with open(tmpfile, 'w') as outfile:
+            json.dump(content, outfile, separators=(',', ':'))
+        os.replace(tmpfile, self.path)
+        self.changed = False
+
+    def invalidate(self):
+        """Remove the mirror from disk, e.g. before an operation which may be interrupted"""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def reset(self, records=()):
+        """Replace all records with (depotFile, rev, digest) tuples and mark the mirror complete"""
+        records = sorted(records)
+        with self._lock:
+            self._depotfiles = [record[0] for record in records]
+            self._revs = array('l', [int(record[1]) for record in records])
+            self._digests = [record[2] or '' for record in records]
+            self._pending = {}
+        self.complete = True
+        self.changed = True
+
+    def update(self, depotfile, rev, digest=''):
+        """Record that the workspace has depotfile at rev"""
+        with self._lock:
+            self._pending[depotfile] = (int(rev), digest or '')
+            self.changed = True
+
+    def remove(self, depotfile):
+        """Record that the workspace no longer has depotfile"""
+        with self._lock:
+            self._pending[depotfile] = None
+            self.changed = True
+
+    def update_from_stat(self, stat):
+        """Apply a tagged sync or flush output record"""
+        if 'depotFile' not in stat:
+            return
+        if stat.get('action') == 'deleted' or not stat.get('rev', '').isdigit():
+            self.remove(stat['depotFile'])
+        else:
+            self.update(stat['depotFile'], stat['rev'], stat.get('digest'))
+
+    def get(self, depotfile):
+        """Get (rev, digest) for a depot file, or None if it is not in the workspace"""
+        self._merge()
+        index = bisect.bisect_left(self._depotfiles, depotfile)
+        if index < len(self._depotfiles) and self._depotfiles[index] == depotfile:
+            return self._revs[index], self._digests[index]
+        return None
+
+    def scan(self, prefix=''):
+        """Yield (depotFile, rev, digest) for every record under a depot path prefix
+
+        Accepts either a plain prefix or a depot path ending in '...', e.g. //depot/dir/...
+        """
+        self._merge()
+        if prefix.endswith('...'):
+            prefix = prefix[:-3]
+        index = bisect.bisect_left(self._depotfiles, prefix)
+        while index < len(self._depotfiles) and self._depotfiles[index].startswith(prefix):
+            yield self._depotfiles[index], self._revs[index], self._digests[index]
+            index += 1
+
+    def _merge(self):
+        """Merge buffered updates into the sorted arrays"""
+        with self._lock:
+            if not self._pending:
+                return
+            pending = sorted(self._pending.items())
+            self._pending = {}
+            depotfiles, revs, digests = [], array('l'), []
+            i = 0
+            for depotfile, record in pending:
+                # Copy unchanged records which sort before this update
+                while i < len(self._depotfiles) and self._depotfiles[i] < depotfile:
+                    depotfiles.append(self._depotfiles[i])
+                    revs.append(self._revs[i])
+                    digests.append(self._digests[i])
+                    i += 1
+                if i < len(self._depotfiles) and self._depotfiles[i] == depotfile:
+                    i += 1 # Replaced or removed by this update
+                if record is not None:
+                    depotfiles.append(depotfile)
+                    revs.append(record[0])
+                    digests.append(record[1])
+            depotfiles.extend(self._depotfiles[i:])
+            revs.extend(self._revs[i:])
+            digests.extend(self._digests[i:])
+            self._depotfiles, self._revs, self._digests = depotfiles, revs, digests
@@ -0,0 +1,257 @@
+"""
+Record the outcome of every checkout to spot regressions and tune sync settings
+"""
+import os
+import math
+import time
+import sqlite3
+import argparse
+import statistics
+
+__HISTORY_FILENAME__ = '.perforce-checkout-history.sqlite'
+
+# Candidate values for parallel: auto, in threads. 0 disables parallel sync.
+__PARALLEL_CANDIDATES__ = [0, 4, 8, 16]
+# Minimum samples before history is trusted to make a decision
+__MIN_SAMPLES__ = 3
+
+__SCHEMA__ = """
+CREATE TABLE IF NOT EXISTS checkouts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    workspace TEXT NOT NULL,
+    client TEXT,
+    success INTEGER NOT NULL,
+    fresh INTEGER,
+    from_change INTEGER,
+    to_change INTEGER,
+    files INTEGER,
+    bytes INTEGER,
+    parallel INTEGER,
+    head_seconds REAL,
+    sync_seconds REAL,
+    unshelve_seconds REAL,
+    total_seconds REAL,
+    transfer_rate REAL,
+    compress INTEGER,
+    port TEXT
+)
+"""
+
+__INDEX__ = "CREATE INDEX IF NOT EXISTS checkouts_workspace_time ON checkouts (workspace, time)"
+
+# Columns added since the first release, with their types, added to older databases when opened
+__ADDED_COLUMNS__ = [('transfer_rate', 'REAL'), ('compress', 'INTEGER'), ('port', 'TEXT')]
+
+__COLUMNS__ = ['time', 'workspace', 'client', 'success', 'fresh', 'from_change', 'to_change',
+               'files', 'bytes', 'parallel', 'head_seconds', 'sync_seconds',
+               'unshelve_seconds', 'total_seconds', 'transfer_rate', 'compress', 'port']
+
+# Number of recent uncompressed syncs used to judge the link to the server
+__LINK_SAMPLES__ = 20
+# Age after which syncs no longer count towards the link rate, so that compressed links are measured again
+__LINK_WINDOW_SECONDS__ = 7 * 24 * 60 * 60
+# Number of recent checkouts of a workspace used to choose sync settings
+__DECISION_SAMPLES__ = 200
+# Checkouts kept in the database, older ones are removed as new ones are recorded
+__MAX_ROWS__ = 50000
+
+
+def default_path():
+    """Location of the history database in the agent's builds directory, if known"""
+    build_path = os.environ.get('BUILDKITE_BUILD_PATH')
+    if not build_path:
+        return None
+    return os.path.join(build_path, __HISTORY_FILENAME__)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of values"""
+    values = sorted(values)
+    if not values:
+        return None
+    index = max(0, min(len(values) - 1, math.ceil(pct / 100.0 * len(values)) - 1))
+    return values[index]
+
+
+class CheckoutHistory:
+    """SQLite database of past checkouts on this agent host"""
+    def __init__(self, path):
+        self.path = path
+        parent = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        # Several agents on one host may write concurrently, wait for their transactions
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute(__SCHEMA__)
+        self.conn.execute(__INDEX__)
+        existing = [row[1] for row in self.conn.execute('PRAGMA table_info(checkouts)')]
+        for column, column_type in __ADDED_COLUMNS__:
+            if column not in existing:
+                self.conn.execute('ALTER TABLE checkouts ADD COLUMN %s %s' % (column, column_type))
+        self.conn.commit()
+
+    @classmethod
+    def open_default(cls):
+        """Open the history database for this agent, or None outside of an agent"""
+        path = default_path()
+        return cls(path) if path else None
+
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()
+
+    def record(self, **outcome):
+        """Append the outcome of a checkout"""
+        outcome.setdefault('time', time.time())
+        columns = [column for column in __COLUMNS__ if column in outcome]
+        self.conn.execute(
+            'INSERT INTO checkouts (%s) VALUES (%s)' % (', '.join(columns), ', '.join('?' * len(columns))),
+            [outcome[column] for column in columns],
+        )
+        self.conn.execute('DELETE FROM checkouts WHERE id <= (SELECT MAX(id) FROM checkouts) - ?', [__MAX_ROWS__])
+        self.conn.commit()
+
+    def rows(self, workspace=None, since=None, until=None, success=True, limit=None):
+        """Get past checkouts as dicts, oldest first, only the most recent limit checkouts if given"""
+        clauses, args = [], []
+        if workspace is not None:
+            clauses.append('workspace = ?')
+            args.append(workspace)
+        if since is not None:
+            clauses.append('time >= ?')
+            args.append(since)
+        if until is not None:
+            clauses.append('time < ?')
+            args.append(until)
+        if success is not None:
+            clauses.append('success = ?')
+            args.append(int(success))
+        query = 'SELECT %s FROM checkouts' % ', '.join(__COLUMNS__)
+        if clauses:
+            query += ' WHERE ' + ' AND '.join(clauses)
+        query += ' ORDER BY time DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            args.append(limit)
+        return [dict(zip(__COLUMNS__, row)) for row in reversed(self.conn.execute(query, args).fetchall())]
+
+    def workspaces(self):
+        """Get every workspace which has history"""
+        return [row[0] for row in self.conn.execute('SELECT DISTINCT workspace FROM checkouts ORDER BY workspace')]
+
+    def best_parallel(self, workspace):
+        """Choose sync parallelism for a workspace from past transfer rates
+
+        Candidates without enough samples are tried first, after that the
+        candidate with the best median transfer rate is used.
+        """
+        rates = {candidate: [] for candidate in __PARALLEL_CANDIDATES__}
+        for row in self.rows(workspace, limit=__DECISION_SAMPLES__):
+            if row['parallel'] in rates and row['bytes'] and row['sync_seconds']:
+                rates[row['parallel']].append(row['bytes'] / row['sync_seconds'])
+        undersampled = [candidate for candidate in __PARALLEL_CANDIDATES__ if len(rates[candidate]) < __MIN_SAMPLES__]
+        if undersampled:
+            return min(undersampled, key=lambda candidate: len(rates[candidate]))
+        return max(__PARALLEL_CANDIDATES__, key=lambda candidate: statistics.median(rates[candidate]))
+
+    def link_rate(self, port):
+        """Median transfer rate in bytes per second of recent syncs from port without compression, across workspaces
+
+        Compressed syncs are left out, since compression changes the rate they measure.
+        Returns None without enough samples in the last week, which turns compression off until
+        uncompressed syncs have measured the link again.
+        """
+        rates = [row[0] for row in self.conn.execute(
+            'SELECT transfer_rate FROM checkouts WHERE success = 1 AND transfer_rate IS NOT NULL'
+            ' AND NOT COALESCE(compress, 0) AND port = ? AND time >= ? ORDER BY time DESC LIMIT ?',
+            [port, time.time() - __LINK_WINDOW_SECONDS__, __LINK_SAMPLES__])]
+        if len(rates) < __MIN_SAMPLES__:
+            return None
+        return statistics.median(rates)
+
+    def prefer_fresh(self, workspace, change_delta):
+        """Predict whether syncing a fresh workspace beats an incremental sync of change_delta changelists"""
+        if not change_delta or change_delta <= 0:
+            return False
+        fresh, per_change = [], []
+        for row in self.rows(workspace, limit=__DECISION_SAMPLES__):
+            if row['sync_seconds'] is None:
+                continue
+            if row['fresh']:
+                fresh.append(row['sync_seconds'])
+            elif row['from_change'] and row['to_change'] and row['to_change'] > row['from_change']:
+                per_change.append(row['sync_seconds'] / (row['to_change'] - row['from_change']))
+        if len(fresh) < __MIN_SAMPLES__ or len(per_change) < __MIN_SAMPLES__:
+            return False
+        return statistics.median(per_change) * change_delta > statistics.median(fresh)
+
+    def regressions(self, days=7, baseline_days=28, threshold=1.5):
+        """Find workspaces where recent checkouts are slower than the preceding baseline
+
+        Returns (workspace, column, baseline median, recent median) tuples.
+        """
+        now = time.time()
+        recent_start = now - days * 86400
+        baseline_start = recent_start - baseline_days * 86400
+        found = []
+        for workspace in self.workspaces():
+            recent = self.rows(workspace, since=recent_start)
+            baseline = self.rows(workspace, since=baseline_start, until=recent_start)
+            for column in ['sync_seconds', 'total_seconds']:
+                recent_values = [row[column] for row in recent if row[column] is not None]
+                baseline_values = [row[column] for row in baseline if row[column] is not None]
+                if len(recent_values) < __MIN_SAMPLES__ or len(baseline_values) < __MIN_SAMPLES__:
+                    continue
+                recent_median = statistics.median(recent_values)
+                baseline_median = statistics.median(baseline_values)
+                if baseline_median and recent_median / baseline_median >= threshold:
+                    found.append((workspace, column, baseline_median, recent_median))
+        return found
+
+
+def report(history, days):
+    """Print checkout duration percentiles per workspace"""
+    since = time.time() - days * 86400
+    print('%-48s %6s %6s %24s %24s' % ('workspace', 'jobs', 'failed', 'sync p50/p90/p99 (s)', 'total p50/p90/p99 (s)'))
+    for workspace in history.workspaces():
+        rows = history.rows(workspace, since=since, success=None)
+        if not rows:
+            continue
+        succeeded = [row for row in rows if row['success']]
+        columns = []
+        for column in ['sync_seconds', 'total_seconds']:
+            values = [row[column] for row in succeeded if row[column] is not None]
+            if values:
+                columns.append('/'.join('%.1f' % percentile(values, pct) for pct in [50, 90, 99]))
+            else:
+                columns.append('-')
+        print('%-48s %6d %6d %24s %24s' % (workspace, len(rows), len(rows) - len(succeeded), columns[0], columns[1]))
+
+
+def main():
+    """Report on checkout history"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db', default=default_path(), help='Path to history database')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    report_parser = subparsers.add_parser('report', help='Checkout duration percentiles per workspace')
+    report_parser.add_argument('--days', type=float, default=7)
+    regressions_parser = subparsers.add_parser('regressions', help='Workspaces whose checkouts got slower')
+    regressions_parser.add_argument('--days', type=float, default=7)
+    regressions_parser.add_argument('--baseline-days', type=float, default=28)
+    regressions_parser.add_argument('--threshold', type=float, default=1.5)
+    args = parser.parse_args()
+    if not args.db:
+        parser.error('--db is required when BUILDKITE_BUILD_PATH is not set')
+
+    history = CheckoutHistory(args.db)
+    if args.command == 'report':
+        report(history, args.days)
+    else:
+        for workspace, column, before, after in history.regressions(args.days, args.baseline_days, args.threshold):
+            print('%s: %s median %.1fs -> %.1fs (%.1fx)' % (workspace, column, before, after, after / before))
+    history.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""
+Simulate many agents checking out concurrently against one server
+
+Each worker process acts as an agent with its own workspace roots and runs a
+mix of fresh syncs, incremental syncs, unshelves and client migrations.
+Throughput, latency percentiles and server performance tracking are reported
+for each concurrency level, e.g.
+    python loadtest.py --concurrency 1 4 16 --ops 20 --parallel 4
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+import multiprocessing
+
+from P4 import P4Exception # pylint: disable=import-error
+
+from perforce import P4Repo
+from history import percentile
+from test_perforce import find_free_port, run_p4d, copytree
+
+__OPERATIONS__ = ['fresh', 'incremental', 'unshelve', 'migration']
+
+
+def parse_mix(mix):
+    """Parse operation weights, e.g. fresh=1,incremental=4"""
+    weights = dict.fromkeys(__OPERATIONS__, 0)
+    for item in mix.split(','):
+        operation, weight = item.split('=')
+        if operation not in weights:
+            raise ValueError('Unknown operation %s, expected one of %s' % (operation, __OPERATIONS__))
+        weights[operation] = float(weight)
+    return weights
+
+
+class Agent:
+    """One simulated agent, run inside a worker process"""
+    def __init__(self, name, workdir, settings):
+        self.name = name
+        self.workdir = workdir
+        self.settings = settings
+        self.root = None
+        self.roots = 0
+        self.clients = []
+        os.environ['BUILDKITE_AGENT_NAME'] = name
+
+    def repo(self, root):
+        """Open a repo for a workspace root, as the checkout hook would"""
+        return P4Repo(root=root, stream=self.settings['stream'], view=self.settings['view'],
+                      parallel=self.settings['parallel'], track=True)
+
+    def new_root(self):
+        """Path to an empty workspace root"""
+        self.roots += 1
+        return os.path.join(self.workdir, '%s-%d' % (self.name, self.roots))
+
+    def run(self, operation):
+        """Run one operation, returning the repo it used"""
+        revisions = self.settings['revisions']
+        if operation == 'fresh' or self.root is None:
+            operation = 'fresh'
+            self.root = self.new_root()
+        elif operation == 'migration':
+            # Copy the workspace to a new root, which creates a new client that flushes to match
+            root = self.new_root()
+            os.makedirs(root)
+            copytree(self.root, root)
+            shutil.rmtree(self.root, ignore_errors=True)
+            self.root = root
+        with self.repo(self.root) as repo:
+            if operation == 'unshelve':
+                repo.sync(revision=revisions[-1])
+                if self.settings['shelves']:
+                    repo.p4print_unshelve(random.choice(self.settings['shelves']))
+            else:
+                repo.sync(revision=random.choice(revisions))
+            self.clients.append(repo.perforce.client)
+        return repo
+
+    def cleanup(self):
+        """Delete clients created by this agent"""
+        with P4Repo() as repo:
+            for client in set(self.clients):
+                try:
+                    repo.perforce.run_client('-d', client)
+                except P4Exception:
+                    pass
+
+
+def run_agent(args):
+    """Worker process entrypoint, returns (operation, seconds, error, tracking) per operation"""
+    index, settings = args
+    random.seed(settings['seed'] + index)
+    operations = random.choices(
+        list(settings['mix'].keys()), weights=list(settings['mix'].values()), k=settings['ops'])
+    results = []
+    with tempfile.TemporaryDirectory(prefix='bk-p4-load-') as workdir:
+        agent = Agent('load-%d' % index, workdir, settings)
+        for operation in operations:
+            start = time.time()
+            error, tracking = None, {}
+            try:
+                repo = agent.run(operation)
+                tracking = repo.tracking.commands
+            except Exception as ex: # pylint: disable=broad-except
+                error = str(ex) or repr(ex)
+            results.append((operation, time.time() - start, error, tracking))
+        agent.cleanup()
+    return results
+
+
+def report(concurrency, elapsed, results):
+    """Print throughput, latency percentiles and server tracking for one concurrency level"""
+    failures = [result for result in results if result[2]]
+    print('\nconcurrency %d: %d operations in %.1fs, %.2f ops/s, %d failed' % (
+        concurrency, len(results), elapsed, len(results) / elapsed, len(failures)))
+    print('  %-12s %6s %10s %10s %10s' % ('operation', 'count', 'p50 (s)', 'p90 (s)', 'p99 (s)'))
+    for operation in __OPERATIONS__:
+        durations = [result[1] for result in results if result[0] == operation and not result[2]]
+        if durations:
+            print('  %-12s %6d %10.2f %10.2f %10.2f' % (
+                operation, len(durations), percentile(durations, 50), percentile(durations, 90), percentile(durations, 99)))
+
+    commands = {}
+    for _, _, _, tracking in results:
+        for command, aggregate in tracking.items():
+            total = commands.setdefault(command, dict.fromkeys(aggregate, 0))
+            for field, value in aggregate.items():
+                total[field] += value
+    print('  %-12s %6s %10s %10s %14s %14s' % ('command', 'count', 'lapse (s)', 'rpc (s)', 'lock wait (ms)', 'lock held (ms)'))
+    for command, total in sorted(commands.items(), key=lambda item: -item[1]['lapse']):
+        print('  %-12s %6d %10.2f %10.2f %14d %14d' % (
+            command, total['count'], total['lapse'], total['rpc'], total['lock_wait'], total['lock_held']))
+    for failure in failures[:5]:
+        print('  failed %s: %s' % (failure[0], failure[2].strip().splitlines()[-1]))
+
+
+def discover(settings):
+    """Find revisions and shelves to use within the workspace"""
+    with tempfile.TemporaryDirectory(prefix='bk-p4-load-') as root:
+        with P4Repo(root=root, stream=settings['stream'], view=settings['view']) as repo:
+            head = repo.head()
+            path = '//%s/...' % repo.perforce.client
+            changes = repo.perforce.run_changes('-m', '10', '-s', 'submitted', path)
+            settings['revisions'] = sorted(['@%s' % change['change'] for change in changes], key=lambda rev: int(rev[1:])) or [head]
+            if settings['shelves'] is None:
+                shelved = repo.perforce.run_changes('-m', '10', '-s', 'shelved')
+                settings['shelves'] = [change['change'] for change in shelved]
+            repo.perforce.run_client('-d', repo.perforce.client)
+
+
+def main():
+    """Run the load test"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', help='P4PORT of an existing server, defaults to a local server from the test fixture')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 2, 4, 8], help='Number of agents at each level')
+    parser.add_argument('--ops', type=int, default=10, help='Operations per agent at each level')
+    parser.add_argument('--mix', default='fresh=1,incremental=4,unshelve=2,migration=1', help='Operation weights')
+    parser.add_argument('--parallel', default=0, help='parallel setting for syncs')
+    parser.add_argument('--stream', help='Stream to check out')
+    parser.add_argument('--view', default='//depot/... ...', help='View to check out if no stream is given')
+    parser.add_argument('--shelf', action='append', dest='shelves', help='Shelved changelists to unshelve')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    settings = {
+        'stream': args.stream,
+        'view': None if args.stream else args.view,
+        'parallel': args.parallel,
+        'shelves': args.shelves,
+        'mix': parse_mix(args.mix),
+        'ops': args.ops,
+        'seed': args.seed,
+    }
+
+    with contextlib.ExitStack() as stack:
+        if args.port:
+            os.environ['P4PORT'] = args.port
+        else:
+            port = 'ssl:localhost:%s' % find_free_port()
+            os.environ['P4PORT'] = port
+            stack.enter_context(run_p4d(port, from_zip='server.zip'))
+            time.sleep(1)
+        discover(settings)
+
+        for concurrency in args.concurrency:
+            start = time.time()
+            with multiprocessing.Pool(concurrency) as pool:
+                per_agent = pool.map(run_agent, [(index, settings) for index in range(concurrency)])
+            report(concurrency, time.time() - start, [result for results in per_agent for result in results])
+
+
+if __name__ == "__main__":
+    main()
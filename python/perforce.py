@@ -8,15 +8,52 @@ import logging
 import sys
 import stat
 import json
+import time
+import shutil
+import hashlib
+import shlex
+import heapq
+import threading
 
 
 # Recommended reference: https://www.perforce.com/manuals/p4python/p4python.pdf
 from P4 import P4, P4Exception, OutputHandler # pylint: disable=import-error
 
+from havetable import HaveTable
+from workspace import mark_ready, clear_ready, save_settings
+from tracking import ServerTracking, TrackedP4
+
+# Directory levels below each sync path which may be split into bootstrap chunks
+__BOOTSTRAP_SPLIT_DEPTH__ = 4
+# With bandwidth: auto, links slower than this (~80Mbit/s) use compression and parallel sync
+__SLOW_LINK_BYTES_PER_SECOND__ = 10 * 1024 * 1024
+__SLOW_LINK_THREADS__ = 8
+# Syncs smaller than this do not measure the transfer rate
+__MIN_RATE_SAMPLE_BYTES__ = 10 * 1024 * 1024
+
+# (P4PORT, fingerprint, P4TRUST) already trusted by this process
+_TRUSTED = set()
+
+def get_logger():
+    """Logger for P4 commands, writing to stdout unless a handler was already added"""
+    logger = logging.getLogger("p4python")
+    logger.setLevel(logging.INFO)
+    if not logger.handlers: # Long running processes may open many repos
+        handler = logging.StreamHandler(sys.stdout)
+        formatter = logging.Formatter(
+            '%(asctime)s %(name)s %(levelname)s: %(message)s',
+            '%H:%M:%S',
+        )
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return logger
+
 class P4Repo:
     """A class for manipulating perforce workspaces"""
     def __init__(self, root=None, view=None, stream=None, sync=None,
-                 client_options=None, client_type=None, parallel=0, fingerprint=None):
+                 client_options=None, client_type=None, parallel=0, fingerprint=None, history=None,
+                 track=False, priority=None, replica=None, host_client=False, bootstrap=0, bandwidth=None,
+                 replica_fingerprint=None):
         """
         root: Directory in which to create the client workspace
         view: Client workspace mapping
@@ -24,58 +61,206 @@ class P4Repo:
         sync: List of paths to sync. Defaults to entire view.
         client_options: Additional options to add to client. (e.g. allwrite)
         client_type: Type of client (writeable, readonly, partitioned)
-        parallel: How many threads to use for parallel sync.
+        parallel: How many threads to use for parallel sync. 'auto' chooses based on history.
         fingerprint: Acceptable fingerprint for a p4 server to have.
+        history: CheckoutHistory of past checkouts, used to tune sync settings.
+        track: Collect server performance tracking for every command.
+        priority: Ordered list of paths to sync and mark ready before the rest of the workspace.
+        replica: P4PORT of a forwarding replica to serve read-only commands, falling back to P4PORT if it lags.
+        host_client: Name the client after the host rather than the agent, for workspaces shared by agents.
+        bootstrap: Number of size-balanced chunks to sync concurrently when populating an empty workspace.
+        bandwidth: 'auto' enables compression and more sync threads when history shows a slow link to the server.
+        replica_fingerprint: Acceptable fingerprint for the replica to have, defaults to fingerprint.
         """
         self.root = os.path.abspath(root or '')
         self.stream = stream
-        self.view = self._localize_view(view or [])
+        self.host_client = host_client
+        self.mappings = view or []
         self.sync_paths = sync or ['//...']
         assert isinstance(self.sync_paths, list)
+        self.priority = priority or []
+        self.replica = replica
+        self.bootstrap = int(bootstrap or 0)
+        self.bandwidth = bandwidth
+        self._slow_link = None
+        self._read_port = None
+        self.compress = False
+        self._replica = None
+        self._replica_client = None # Client the replica is known to have replayed
         self.client_options = client_options or ''
         self.client_type = client_type or 'writeable'
         self.parallel = parallel
         self.fingerprint = fingerprint or ''
+        self.replica_fingerprint = replica_fingerprint or self.fingerprint
+        self.history = history
+        self.tracking = ServerTracking() if track else None
 
         self.created_client = False
+        self._client_view = None # View saved by _setup_client, if known without fetching the spec again
+        self.sync_stats = {}
+        self._label_revisions = {}
         self.patchfile = os.path.join(self.root, 'patched.json')
         self.p4config = os.path.join(self.root, 'p4config')
+        self.blessfile = os.path.join(self.root, 'bless.version')
+        self.manifest = ChangeManifest(os.path.join(self.root, 'manifest.jsonl'))
+        self.havetable = HaveTable(os.path.join(self.root, 'have.json'))
 
-        self.perforce = P4()
-        self.perforce.disable_tmp_cleanup() # Required to use multiple P4 connections in parallel safely
-        self.perforce.exception_level = 1  # Only errors are raised as exceptions
-        logger = logging.getLogger("p4python")
-        logger.setLevel(logging.INFO)
-        handler = logging.StreamHandler(sys.stdout)
-        formatter = logging.Formatter(
-            '%(asctime)s %(name)s %(levelname)s: %(message)s',
-            '%H:%M:%S',
-        )
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        self.perforce.logger = logger
-        self.perforce.connect()
-
-        if self.perforce.port.startswith('ssl'):
-            if self.fingerprint:
-                self.perforce.run_trust(
-                    '-r',       # Install a replacement fingerprint - will replace primary if this matches the server
-                    '-i',       # Install the specified fingerprint
-                    self.fingerprint,
-                )
+        self._perforce = None
+
+    @property
+    def perforce(self):
+        """Primary connection, connected and trusted on first use"""
+        if self._perforce is None:
+            perforce = self._new_connection()
+            perforce.disable_tmp_cleanup() # Required to use multiple P4 connections in parallel safely
+            perforce.exception_level = 1  # Only errors are raised as exceptions
+            perforce.logger = get_logger()
+            perforce.connect()
+            try:
+                self._trust(perforce, self.fingerprint)
+            except P4Exception:
+                perforce.disconnect()
+                raise
+            self._perforce = perforce
+        return self._perforce
+
+    @staticmethod
+    def _trust(perforce, fingerprint):
+        """Trust a server's fingerprint, once per server, fingerprint and trust file in this process"""
+        # get_config() gives the fingerprint as a list
+        key = (perforce.port, tuple(fingerprint) if isinstance(fingerprint, list) else fingerprint,
+               os.environ.get('P4TRUST'))
+        if not perforce.port.startswith('ssl') or key in _TRUSTED:
+            return
+        if fingerprint:
+            perforce.run_trust(
+                '-r',       # Install a replacement fingerprint - will replace primary if this matches the server
+                '-i',       # Install the specified fingerprint
+                fingerprint,
+            )
+        else:
+            # Trust fingerprint from first contact with server
+            # If fingerprint changes, MITM attack is reported
+            perforce.run_trust('-y')
+        _TRUSTED.add(key)
+
+    @property
+    def view(self):
+        """Client workspace view, named after the client this repo resolves to"""
+        return self._localize_view(self.mappings)
+
+    def connected(self):
+        """Whether the primary connection is open, without opening it"""
+        return self._perforce is not None and self._perforce.connected()
+
+    def close(self):
+        """Disconnect from the server, the next command connects and sets up the client again"""
+        for perforce in (self._perforce, self._replica):
+            if perforce is not None and perforce.connected():
+                perforce.disconnect()
+        self._perforce = None
+        self._replica = None
+        self.created_client = False # A new connection has no client set
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def refresh(self):
+        """Forget state which other processes may have changed, before reusing this repo for another checkout"""
+        if not os.path.isfile(self.p4config):
+            self.created_client = False # Workspace was removed, set it up again
+        elif self.created_client:
+            if not self._client_matches(self.perforce.fetch_client(self.perforce.client)):
+                self.created_client = False # Another configuration changed the client, set it up again
             else:
-                # Trust fingerprint from first contact with server
-                # If fingerprint changes, MITM attack is reported
-                self.perforce.run_trust('-y')
+                self.havetable.load()
+        self._label_revisions = {}
+        self._slow_link = None
+        self.sync_stats = {}
+        if self.tracking:
+            self.tracking.reset()
+
+    def _client_matches(self, client):
+        """Whether an existing client spec has the stream, type and view this repo would set up"""
+        # Without a stream or view, _setup_client keeps the view the client already has
+        return 'Update' in client and client.get('Stream') == self.stream and \
+            client.get('Type') == self.client_type and (self.stream or not self.view or client.get('View') == self.view)
+
+    def _previous_clientname(self):
+        """Client named in the workspace's p4config by the last checkout"""
+        with open(self.p4config) as infile:
+            return next(line.split('=', 1)[-1]
+                for line in infile.read().splitlines() # removes \n
+                if line.startswith('P4CLIENT='))
+
+    def _new_connection(self):
+        """Create a P4 connection, collecting performance tracking if enabled"""
+        if self.tracking:
+            return TrackedP4(self.tracking)
+        return P4()
 
-    def __del__(self):
-        self.perforce.disconnect()
+    def _reader(self, changelist):
+        """Connection for read-only commands at a changelist, the replica unless it lags behind it
+
+        Spec and have table writes always go to the primary connection, self.perforce.
+        """
+        reader = self._pick_reader(changelist)
+        self._read_port = reader.port # Server the last sync measured, see CheckoutHistory.link_rate
+        return reader
+
+    def _pick_reader(self, changelist):
+        """Choose between the replica and primary connections, see _reader"""
+        if not self.replica or changelist is None:
+            return self.perforce
+        try:
+            if self._replica is None:
+                replica = self._new_connection()
+                replica.port = self.replica
+                replica.user = self.perforce.user
+                replica.exception_level = self.perforce.exception_level
+                replica.logger = self.perforce.logger
+                replica.connect()
+                try:
+                    self._trust(replica, self.replica_fingerprint)
+                except P4Exception:
+                    replica.disconnect()
+                    raise
+                self._replica = replica
+            replica_change = int(self._replica.run_counter('change')[0]['value'])
+            # Client specs saved on the primary reach the replica later, e.g. for a new agent or overlay
+            replica_client = self.created_client and self._replica_client != self.perforce.client and \
+                self._replica.fetch_client(self.perforce.client)
+        except P4Exception as ex:
+            self.perforce.logger.warning("replica %s unavailable, using %s: %s" % (self.replica, self.perforce.port, ex))
+            return self.perforce
+        if replica_change < changelist:
+            self.perforce.logger.warning("replica %s is at changelist %d, behind %d, using %s" % (
+                self.replica, replica_change, changelist, self.perforce.port))
+            return self.perforce
+        if replica_client:
+            if not self._client_matches(replica_client):
+                self.perforce.logger.warning("replica %s does not have client %s yet, using %s" % (
+                    self.replica, self.perforce.client, self.perforce.port))
+                return self.perforce
+            self._replica_client = self.perforce.client
+        self._replica.client = self.perforce.client
+        return self._replica
 
     def _get_clientname(self):
         """Get unique clientname for this host and location on disk"""
-        clientname = 'bk-p4-%s-%s' % (os.environ.get('BUILDKITE_AGENT_NAME', socket.gethostname()), os.path.basename(self.root))
+        owner = socket.gethostname() if self.host_client else os.environ.get('BUILDKITE_AGENT_NAME', socket.gethostname())
+        clientname = 'bk-p4-%s-%s' % (owner, os.path.basename(self.root))
         return re.sub(r'\W', '-', clientname)
 
+    def history_key(self):
+        """Identify the workspace content in checkout history, independent of host"""
+        if self.stream:
+            return self.stream
+        return ' '.join(mapping.split(' ')[0] for mapping in self.view) or '//...'
+
     def _localize_view(self, view):
         """Convert path mapping to be a client workspace view"""
         if not isinstance(view, list):
@@ -97,12 +282,13 @@ class P4Repo:
             current_client._stream = prev_client._stream
             self.perforce.save_client(current_client)
 
-        self.perforce.run_flush(['//...@%s' % prev_clientname])
+        flushed = self.perforce.run_flush(['//...@%s' % prev_clientname])
 
         if stream_switch:
             self.perforce.logger.info("switching stream back to %s" % self.stream)
             current_client._stream = self.stream
             self.perforce.save_client(current_client)
+        return flushed
 
     def _flush_to_stream_and_changelist(self, current_client, prev_client_stream, prev_client_changelist):
         """
@@ -116,12 +302,13 @@ class P4Repo:
             current_client._stream = prev_client_stream
             self.perforce.save_client(current_client)
 
-        self.perforce.run_flush(['//...@%s' % prev_client_changelist])
+        flushed = self.perforce.run_flush(['//...@%s' % prev_client_changelist])
 
         if stream_switch:
             self.perforce.logger.info("switching stream back to %s" % self.stream)
             current_client._stream = self.stream
             self.perforce.save_client(current_client)
+        return flushed
 
     def _setup_client(self):
         """Creates or re-uses the client workspace for this machine"""
@@ -132,6 +319,8 @@ class P4Repo:
         # must be set prior to running any commands to avoid issues with default client names
         self.perforce.client = clientname
         client = self.perforce.fetch_client(clientname)
+        # Stream clients get their view from the stream when saved, known already if it is the same stream
+        stream_unchanged = 'Update' in client and client.get('Stream') == self.stream
         if self.root:
             client._root = self.root
         if self.stream:
@@ -142,7 +331,11 @@ class P4Repo:
 
         # unless overidden, overwrite writeable-but-unopened files
         # (e.g. interrupted syncs, artefacts that have been checked-in)
-        client._options = self.client_options + ' clobber'
+        options = self.client_options.split()
+        if self.is_slow_link() and 'compress' not in options and 'nocompress' not in options:
+            options.append('compress')
+        client._options = ' '.join(options + ['clobber'])
+        self.compress = 'compress' in options
         
         # revert changes in client before saving to avoid an error if files are still open in client
         try:
@@ -153,43 +346,78 @@ class P4Repo:
             pass
 
         self.perforce.save_client(client)
+        self._client_view = client._view if not self.stream or stream_unchanged else None
+        self._replica_client = None
+
+        self.havetable.client = clientname
+        if 'Update' not in client:
+            self.havetable.reset() # New clients have nothing synced
+        else:
+            self.havetable.load()
 
         if os.path.isfile(self.p4config):
-            with open(self.p4config) as infile:
-                prev_clientname = next(line.split('=', 1)[-1]
-                    for line in infile.read().splitlines() # removes \n
-                    if line.startswith('P4CLIENT='))
+            prev_clientname = self._previous_clientname()
             # p4 flush @client is only supported for writeable
             if prev_clientname != clientname:
                 need_full_clean = True
-                bless_version_file = os.path.join(self.root, "bless.version")
                 if self.client_type == "writeable":
                     self.perforce.logger.warning("p4config last client was %s, flushing workspace to match" % prev_clientname)
-                    self._flush_to_previous_client(client, prev_clientname)
+                    self._apply_flushed(self._flush_to_previous_client(client, prev_clientname))
                     need_full_clean = False
-                elif os.path.isfile(bless_version_file):
-                    with open(bless_version_file, 'r') as file:
-                        # The bless version file has the format stream@CL, e.g. //depot/main@123456
-                        blessed_version_string = file.read().strip()
-                        blessed_stream_and_version = blessed_version_string.split('@')
-                        if len(blessed_stream_and_version) == 2:
-                            self.perforce.logger.warning("flushing workspace to previously blessed version: stream %s at changelist %s" % (blessed_stream_and_version[0], blessed_stream_and_version[1]))
-                            self._flush_to_stream_and_changelist(client, blessed_stream_and_version[0], blessed_stream_and_version[1])
-                            need_full_clean = False
-                        else:
-                            self.perforce.logger.warning("invalid bless.version format: %s. Expected format is stream@CL, e.g. //depot/main@123456" % blessed_version_string)
-                
+                elif os.path.isfile(self.blessfile):
+                    blessed_stream_and_version = self._read_bless_version()
+                    if blessed_stream_and_version:
+                        self.perforce.logger.warning("flushing workspace to previously blessed version: stream %s at changelist %s" % blessed_stream_and_version)
+                        self._apply_flushed(self._flush_to_stream_and_changelist(
+                            client, blessed_stream_and_version[0], blessed_stream_and_version[1]))
+                        need_full_clean = False
+
                 if need_full_clean:
                     self.perforce.logger.warning("cleaning workspace to ensure have table is correctly populated. Due to lack of bless.version file in root and mismatched with previous clientname %s" % prev_clientname)
                     self.perforce.run_clean(['-a', '-d', '//...'])
+                    self.havetable.save() # p4 clean removed the mirror along with other files not in the depot
 
         elif 'Update' in client: # client was accessed previously
             self.perforce.logger.warning("p4config missing for previously accessed client workspace. flushing to revision zero")
             self.perforce.run_flush(['//...@0'])
+            self.havetable.reset()
 
         self._write_p4config()
+        save_settings(self.root, {'sync': self.sync_paths, 'client_type': self.client_type})
+        if self.havetable.changed:
+            self.havetable.save()
         self.created_client = True
 
+    def attach_client(self, clientname):
+        """Use an existing client workspace without modifying its spec
+
+        For background processes acting on a workspace set up by a previous job.
+        """
+        self.perforce.client = clientname
+        self.havetable.client = clientname
+        self.havetable.load()
+        self.created_client = True
+
+    def _apply_flushed(self, flushed):
+        """Update the have table mirror from the output of p4 flush"""
+        if not self.havetable.complete:
+            return
+        for record in flushed:
+            if isinstance(record, dict):
+                self.havetable.update_from_stat(record)
+
+    def _have_table(self):
+        """Get the have table mirror, populating it from the server if it is unknown"""
+        if not self.havetable.complete:
+            self.perforce.logger.info("have table mirror missing, fetching have list from server")
+            self.havetable.reset(
+                (item['depotFile'], item['haveRev'], '')
+                for item in self.perforce.run_have('//%s/...' % self.perforce.client)
+                if 'depotFile' in item
+            )
+            self.havetable.save()
+        return self.havetable
+
     def _write_p4config(self):
         """Writes a p4config at the workspace root"""
         config = {
@@ -202,6 +430,40 @@ class P4Repo:
         with open(self.p4config, 'w') as p4config:
             p4config.writelines(["%s=%s\n" % (k, v) for k, v in config.items()])
 
+    def _read_bless_version(self):
+        """Read the stream and changelist the workspace was last fully synced to, if known
+
+        The bless version file has the format stream@CL, e.g. //depot/main@123456,
+        optionally followed by a line with a checksum of the first line.
+        """
+        with open(self.blessfile, 'r') as infile:
+            lines = infile.read().strip().splitlines() or ['']
+        blessed_version_string = lines[0].strip()
+        blessed_stream_and_version = blessed_version_string.split('@')
+        if len(blessed_stream_and_version) != 2:
+            self.perforce.logger.warning("invalid bless.version format: %s. Expected format is stream@CL, e.g. //depot/main@123456" % blessed_version_string)
+            return None
+        if len(lines) > 1 and lines[1].strip() != bless_checksum(blessed_version_string):
+            self.perforce.logger.warning("invalid bless.version checksum for %s" % blessed_version_string)
+            return None
+        return tuple(blessed_stream_and_version)
+
+    def _write_bless_version(self, changelist):
+        """Record that the workspace is an unmodified copy of the stream at a changelist
+
+        Allows readonly and partitioned clients to migrate without a full clean.
+        """
+        blessed_version_string = '%s@%s' % (self.stream, changelist)
+        tmpfile = '%s.tmp' % self.blessfile
+        with open(tmpfile, 'w') as outfile:
+            outfile.write('%s\n%s\n' % (blessed_version_string, bless_checksum(blessed_version_string)))
+        os.replace(tmpfile, self.blessfile)
+
+    def _invalidate_bless_version(self):
+        """Remove the bless version file once the workspace may no longer match it"""
+        if os.path.isfile(self.blessfile):
+            os.remove(self.blessfile)
+
     def _read_patched(self):
         """Read a marker to find which files have been modified in the workspace"""
         if not os.path.exists(self.patchfile):
@@ -222,9 +484,21 @@ class P4Repo:
             Does not detect modified files
         """
         self._setup_client()
+        blessed = os.path.isfile(self.blessfile) and self._read_bless_version()
         # TODO: Add a fast implementation of p4 clean here
         self.perforce.run_clean(['-a', '-d', '//%s/...' % self._get_clientname()])
         self._write_p4config()
+        if blessed:
+            # Workspace matches the have table again, so it is still the blessed version
+            self._write_bless_version(blessed[1])
+        # p4 clean removed the mirror too, the have table itself is unchanged
+        self.havetable.save()
+
+    def have(self, path='//...'):
+        """Get files synced to the workspace under a depot path, without querying the server"""
+        self._setup_client()
+        return [{'depotFile': depotfile, 'haveRev': str(rev), 'digest': digest}
+                for depotfile, rev, digest in self._have_table().scan(path)]
 
     def info(self):
         """Get server info"""
@@ -234,27 +508,72 @@ class P4Repo:
         """Get current head revision"""
         self._setup_client()
         # Get head based on client view (e.g. within the stream)
-        client_head = self.head_at_revision('//%s/...' % self._get_clientname())
+        client_head = self._head_of_view(self._client_view or self.perforce.fetch_client(self.perforce.client)['View'])
         if client_head:
             return '@' + client_head
         # Fallback for when client view has no submitted changes, global head revision
         return '@' + self.perforce.run_counter("maxCommitChange")[0]['value']
 
+    def _head_of_view(self, view):
+        """Get head submitted changelist within a client view
+
+        Equivalent to `p4 changes -m1 //client/...`, which is slow on large views.
+        Instead query the whole stream at once where it is fully mapped,
+        otherwise query each view line concurrently and take the maximum.
+        """
+        depot_paths = view_depot_paths(view)
+        if not depot_paths:
+            # Exclusion mappings can hide changes within a view line, query the client view as a whole
+            return self.head_at_revision('//%s/...' % self.perforce.client)
+        return self._head_of_depot_paths(depot_paths)
+
+    def head_without_client(self):
+        """Get current head revision from the stream or view, without creating a client workspace
+
+        Exclusion mappings cannot be applied without a client, so a change to excluded
+        files may be reported as head. Syncing to it is equivalent to syncing the true head.
+        """
+        if self.stream:
+            # -v includes the client view generated from the stream spec
+            view = self.perforce.fetch_stream('-v', self.stream).get('View') or ['%s/... ...' % self.stream]
+        else:
+            view = self.view
+        depot_paths = view_depot_paths(view, skip_exclusions=True)
+        head = self._head_of_depot_paths(depot_paths) if depot_paths else None
+        if head:
+            return '@' + head
+        return '@' + self.perforce.run_counter("maxCommitChange")[0]['value']
+
+    def _head_of_depot_paths(self, depot_paths):
+        """Get head submitted changelist across depot paths"""
+        stream_path = '%s/...' % self.stream if self.stream else None
+        if stream_path in depot_paths and all(path.startswith(stream_path[:-3]) for path in depot_paths):
+            return self.head_at_revision('%s@now' % stream_path)
+
+        if len(depot_paths) == 1:
+            return self.head_at_revision(depot_paths[0])
+        results = self.run_parallel_cmds(
+            [('changes', '-m', '1', '-s', 'submitted', path) for path in depot_paths])
+        changes = [int(change['change']) for result in results for change in result]
+        return str(max(changes)) if changes else None
+
     def head_at_revision(self, revision):
         """Get head submitted changelist at revision specifier"""
         stripped_revision = revision.lstrip('@')
-        if not (stripped_revision.isdigit() or stripped_revision.endswith('...')):
+        if not (stripped_revision.isdigit() or stripped_revision.endswith('...') or stripped_revision.startswith('//')):
             # Revision spec is not a concrete changelist or view
-            try:
-                # Resolve revision directly for automatic labels
-                # Improves performance when label is significantly behind HEAD
-                labelinfo = self.perforce.fetch_label(stripped_revision)
-                 # Revision field is optional
-                revision = labelinfo.get('Revision') or revision
-            except P4Exception:
-                # revision may be clientname, datespec or something else
-                # fallback to default behaviour
-                pass
+            if stripped_revision not in self._label_revisions:
+                try:
+                    # Resolve revision directly for automatic labels
+                    # Improves performance when label is significantly behind HEAD
+                    labelinfo = self.perforce.fetch_label(stripped_revision)
+                     # Revision field is optional
+                    self._label_revisions[stripped_revision] = labelinfo.get('Revision')
+                except P4Exception:
+                    # revision may be clientname, datespec or something else
+                    # fallback to default behaviour
+                    self._label_revisions[stripped_revision] = None
+            revision = self._label_revisions[stripped_revision] or revision
 
         # Get last submitted change at revision spec
         changeinfo = self.perforce.run_changes([
@@ -266,64 +585,319 @@ class P4Repo:
 
     def description(self, changelist):
         """Get description of a given changelist number"""
-        return self.perforce.run_describe(str(changelist))[0]['desc']
+        return self._reader(int(changelist)).run_describe(str(changelist))[0]['desc']
 
-    def sync(self, revision=None):
-        """Sync the workspace"""
+    def at_revision(self, revision):
+        """Whether the workspace holds exactly a changelist revision, with nothing unshelved
+
+        Only reads the workspace and client spec, so it is safe while other jobs use the workspace.
+        """
+        clientname = self._get_clientname()
+        if changelist_number(revision) is None or os.path.exists(self.patchfile) or \
+                not os.path.isfile(self.p4config) or self._previous_clientname() != clientname or \
+                not self._client_matches(self.perforce.fetch_client(clientname)):
+            return False
+        self.perforce.client = clientname
+        self.havetable.client = clientname
+        self.havetable.load()
+        return self.havetable.complete and self.havetable.revision == revision
+
+    def sync(self, revision=None, max_files=None, defer=False):
+        """Sync the workspace, optionally limited to a batch of max_files
+
+        Priority paths are synced first and marked ready as each one lands, see workspace.wait_ready.
+        With defer, only the priority paths are synced and finish_sync() must be called for the rest.
+        """
         self._setup_client()
-        self.revert()
-        sync_files = ['%s%s' % (path, revision or '') for path in self.sync_paths]
-        result = self.perforce.run_sync(
-            '--parallel=threads=%s' % self.parallel,
-            *sync_files,
-            handler=SyncOutput(self.perforce.logger),
-        )
-        if result:
+        reverted = self.revert()
+        # Without a mirror, syncs are only recorded in memory, see HaveTable.save
+        havetable = self.havetable
+        fresh = havetable.complete and len(havetable) == 0
+        from_change = changelist_number(havetable.revision)
+        to_change = changelist_number(revision)
+        if not fresh and from_change and to_change and self.history and \
+                self.history.prefer_fresh(self.history_key(), to_change - from_change):
+            self.perforce.logger.warning("history predicts syncing %d changelists is slower than a fresh workspace, emptying workspace" % (
+                to_change - from_change))
+            self._empty_workspace()
+            fresh = True
+        parallel = self._sync_parallelism()
+
+        # An interrupted sync leaves the mirror out of date, remove it until the sync completes
+        havetable.invalidate()
+        self._invalidate_bless_version()
+        clear_ready(self.root)
+        if max_files:
+            self.manifest.start_background(revision)
+        else:
+            self.manifest.start(previous=havetable.revision, revision=revision, fresh=fresh)
+        for localfile in reverted:
+            self.manifest.write({'path': localfile, 'action': 'reverted'})
+
+        # Batches are for background processes, where there is nobody waiting on priority paths
+        groups = [[path] for path in self.priority if not max_files]
+        bootstrap = fresh and self.bootstrap and not max_files and not defer and changelist_number(revision)
+        if not defer and not bootstrap:
+            groups.append(self.sync_paths)
+        start = time.time()
+        handler = SyncOutput(self.perforce.logger, havetable, self.manifest)
+        result = self._sync_groups(groups, revision, parallel, max_files, handler)
+        bootstrapped = {'files': 0, 'bytes': 0}
+        if bootstrap:
+            bootstrapped, fixup = self._bootstrap(self.sync_paths, revision, parallel, handler)
+            result.extend(fixup)
+        if defer:
+            havetable.revision = None
+            havetable.save()
+            self.manifest.close() # Incomplete until finish_sync()
+        else:
+            # A full batch may have left files behind, so the workspace revision is unknown
+            self._finish_workspace(revision if not max_files or len(result) < max_files else None)
+        self.sync_stats = {
+            'fresh': fresh,
+            'from_change': from_change,
+            'to_change': to_change,
+            'files': bootstrapped['files'] + sum(int(item['totalFileCount']) for item in result if 'totalFileCount' in item),
+            'bytes': bootstrapped['bytes'] + sum(int(item['totalFileSize']) for item in result if 'totalFileSize' in item),
+            'parallel': int(parallel),
+            'sync_seconds': time.time() - start,
+            'compress': self.compress,
+            'port': self._read_port,
+        }
+        transferred = handler.transferred + bootstrapped['bytes']
+        # Small syncs are dominated by latency rather than bandwidth
+        if transferred >= __MIN_RATE_SAMPLE_BYTES__:
+            self.sync_stats['transfer_rate'] = transferred / self.sync_stats['sync_seconds']
+        if result or bootstrap:
             self.perforce.logger.info("Synced %s files (%s)" % (
-                result[0]['totalFileCount'], sizeof_fmt(int(result[0]['totalFileSize']))))
+                self.sync_stats['files'], sizeof_fmt(self.sync_stats['bytes'])))
         return result
 
+    def finish_sync(self, revision=None):
+        """Sync the rest of the workspace after sync(defer=True)
+
+        Runs while the build uses the workspace, so a new repo attaches to the client the checkout
+        set up rather than setting it up again, which would revert files the build has opened.
+        """
+        if not self.created_client:
+            self.attach_client(self._previous_clientname())
+        self.havetable.invalidate()
+        self.manifest.resume(revision)
+        start = time.time()
+        result = self._sync_groups([self.sync_paths], revision, self._sync_parallelism())
+        self._finish_workspace(revision)
+        self.perforce.logger.info("Finished sync in %.1fs" % (time.time() - start))
+        return result
+
+    def _sync_groups(self, groups, revision, parallel, max_files=None, handler=None):
+        """Sync each group of paths in order, marking paths ready once a group has landed"""
+        perforce = self._reader(changelist_number(revision))
+        batch_args = ['-m', str(max_files)] if max_files else []
+        handler = handler or SyncOutput(self.perforce.logger, self.havetable, self.manifest)
+        result = []
+        for paths in groups:
+            group_result = perforce.run_sync(
+                '--parallel=threads=%s' % parallel,
+                *batch_args,
+                *['%s%s' % (path, revision or '') for path in paths],
+                handler=handler,
+            )
+            result.extend(group_result)
+            if not max_files or len(group_result) < max_files:
+                for path in paths:
+                    mark_ready(self.root, path)
+        return result
+
+    def _bootstrap(self, paths, revision, parallel, handler):
+        """Populate an empty workspace by syncing size-balanced chunks of paths concurrently
+
+        Returns ({'files': n, 'bytes': n} estimated from the chunks, output of the final sync),
+        where the final sync of all paths picks up anything the chunks missed.
+        """
+        # e.g. //... => //my-client/..., so that it can be split into directories
+        paths = ['//%s/...' % self.perforce.client if path == '//...' else path for path in paths]
+        reader = self._reader(changelist_number(revision))
+        chunks = self._bootstrap_chunks(paths, revision, reader)
+        total = {'files': sum(files for files, _ in chunks.values()), 'bytes': sum(size for _, size in chunks.values())}
+
+        # Longest processing time first: each chunk goes to the connection with the least data so far
+        connections = [(0, index, []) for index in range(min(self.bootstrap, len(chunks)))]
+        for path, (_, size) in sorted(chunks.items(), key=lambda item: -item[1][1]):
+            load, index, assigned = heapq.heappop(connections)
+            assigned.append(path)
+            heapq.heappush(connections, (load + size, index, assigned))
+        self.perforce.logger.info("bootstrapping %s files (%s) in %d chunks over %d connections" % (
+            total['files'], sizeof_fmt(total['bytes']), len(chunks), len(connections)))
+        if connections:
+            self.run_parallel_cmds(
+                [['sync', '-q', '--parallel=threads=%s' % parallel] + ['%s%s' % (path, revision) for path in assigned]
+                 for _, _, assigned in connections],
+                max_parallel=len(connections), server=reader)
+
+        have = [item for item in self.perforce.run_have('//%s/...' % self.perforce.client) if 'depotFile' in item]
+        self.havetable.reset((item['depotFile'], item['haveRev'], '') for item in have)
+        for item in have:
+            self.manifest.write({'depotFile': item['depotFile'], 'path': item['path'], 'rev': item['haveRev'], 'action': 'added'})
+
+        # Verify the have table matches a single sync, e.g. files added since the chunks were measured
+        fixup = reader.run_sync(
+            '--parallel=threads=%s' % parallel,
+            *['%s%s' % (path, revision) for path in paths],
+            handler=handler,
+        )
+        if fixup:
+            self.perforce.logger.warning("bootstrap missed %s files, synced them individually" % fixup[0].get('totalFileCount', len(fixup)))
+        for path in paths:
+            mark_ready(self.root, path)
+        return total, fixup
+
+    def _bootstrap_chunks(self, paths, revision, reader):
+        """Split paths into chunks for bootstrap, returns {path: (files, bytes)}
+
+        Directories much larger than an even share are split into their subdirectories
+        and the files directly within them, measured with `p4 sizes -s`.
+        """
+        def measure(parts):
+            results = self.run_parallel_cmds([('sizes', '-s', '%s%s' % (part, revision)) for part in parts], server=reader)
+            return {part: (int(result[0]['fileCount']), int(result[0]['fileSize']))
+                    for part, result in zip(parts, results)
+                    if result and int(result[0].get('fileCount', 0))}
+
+        chunks = measure(paths)
+        for _ in range(__BOOTSTRAP_SPLIT_DEPTH__):
+            # Several chunks per connection lets them balance out
+            target = sum(size for _, size in chunks.values()) / (self.bootstrap * 4)
+            large = [path for path, (_, size) in chunks.items() if size > target and path.endswith('/...')]
+            if not large:
+                break
+            for path in large:
+                del chunks[path]
+                base = path[:-len('/...')]
+                subdirs = reader.run_dirs('%s/*%s' % (base, revision))
+                chunks.update(measure(['%s/*' % base] + ['%s/...' % item['dir'] for item in subdirs if 'dir' in item]))
+        return chunks
+
+    def _finish_workspace(self, revision):
+        """Record a completed sync in the have table mirror, bless file and manifest"""
+        self.havetable.revision = revision
+        self.havetable.save()
+        if self.client_type in ('readonly', 'partitioned') and self.stream and self.sync_paths == ['//...'] \
+                and changelist_number(revision) is not None and not os.path.exists(self.patchfile):
+            self._write_bless_version(changelist_number(revision))
+        self.manifest.write({'complete': True})
+        self.manifest.close()
+        if revision is not None:
+            mark_ready(self.root, '//...')
+
+    def is_slow_link(self):
+        """Whether checkout history shows a slow link to the server, with bandwidth: auto"""
+        if self._slow_link is None:
+            port = self.replica or self.perforce.port # Where syncs are expected to come from
+            link_rate = self.history.link_rate(port) if self.bandwidth == 'auto' and self.history else None
+            self._slow_link = link_rate is not None and link_rate < __SLOW_LINK_BYTES_PER_SECOND__
+            if link_rate is not None:
+                self.perforce.logger.info("history shows a transfer rate of %s/s, %s" % (
+                    sizeof_fmt(link_rate), 'enabling compression' if self._slow_link else 'no compression needed'))
+        return self._slow_link
+
+    def _sync_parallelism(self):
+        """Number of threads to use for sync"""
+        if self.parallel != 'auto':
+            if not int(self.parallel) and self.is_slow_link():
+                return __SLOW_LINK_THREADS__ # Overlap round trips on high latency links
+            return self.parallel
+        if not self.history:
+            return 0
+        parallel = self.history.best_parallel(self.history_key())
+        self.perforce.logger.info("chose parallel sync with %s threads from checkout history" % parallel)
+        return parallel
+
+    def _empty_workspace(self):
+        """Remove all workspace files so that the next sync starts from scratch"""
+        self.perforce.run_flush(['//...@0'])
+        self.havetable.reset()
+
+        def remove_readonly(func, path, _):
+            """Make synced files writeable so they can be removed"""
+            os.chmod(path, stat.S_IWRITE)
+            func(path)
+
+        for item in os.listdir(self.root):
+            path = os.path.join(self.root, item)
+            if path == self.p4config:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, onerror=remove_readonly)
+            else:
+                remove_readonly(os.unlink, path, None)
+
     def revert(self):
-        """Revert any pending changes in the workspace"""
+        """Revert any pending changes in the workspace, returns local paths of restored files"""
         self._setup_client()
         self.perforce.run_revert('-w', '//...')
         patched = self._read_patched()
         if patched:
             self.perforce.run_clean(patched)
+        if os.path.exists(self.patchfile):
             os.remove(self.patchfile)
+        return patched
+
+    def run_parallel_cmds(self, cmds, max_parallel=20, server=None):
+        """Run p4 cmds concurrently, returning the result of each cmd in order
 
-    def run_parallel_cmds(self, cmds, max_parallel=20):
+        server: Connection whose settings to use, defaults to the primary.
+        """
+        server = server or self.perforce
         def run(*args):
             """Acquire new connection and run p4 cmd"""
-            perforce = P4()
-            perforce.exception_level = self.perforce.exception_level
-            perforce.logger = self.perforce.logger
+            perforce = self._new_connection()
+            perforce.port = server.port
+            perforce.user = server.user
+            perforce.client = server.client
+            perforce.exception_level = server.exception_level
+            perforce.logger = server.logger
             perforce.connect()
-            perforce.run(*args)
+            try:
+                return perforce.run(*args)
+            finally:
+                perforce.disconnect()
 
         from concurrent.futures import ThreadPoolExecutor
         with ThreadPoolExecutor(max_workers=max_parallel) as executor:
-            executor.map(run, cmds)
+            return list(executor.map(run, cmds))
 
-    def p4print_unshelve(self, changelist):
-        """Unshelve a pending change by p4printing the contents into a file"""
-        self._setup_client()
+    def p4print_unshelve(self, changelists):
+        """Unshelve pending changes by p4printing the contents into files
 
-        changeinfo = self.perforce.run_describe('-S', changelist)
-        if not changeinfo:
-            raise Exception('Changelist %s does not contain any shelved files.' % changelist)
-        changeinfo = changeinfo[0]
+        changelists: A shelved changelist, or a list of stacked shelved changelists from
+                     bottom to top. Each file is printed once, from the topmost shelf containing it.
+        """
+        self._setup_client()
+        if not isinstance(changelists, list):
+            changelists = [changelists]
 
-        if 'depotFile' not in changeinfo:
-            raise Exception('Changelist %s does not contain any shelved files' % changelist)
-        depotfiles = changeinfo['depotFile']
-        
+        reader = self._reader(max(int(changelist) for changelist in changelists))
+        changeinfos = {info['change']: info for info in reader.run_describe('-S', *changelists)
+                       if isinstance(info, dict) and 'change' in info}
+        depot_to_change = {}
+        for changelist in changelists:
+            changeinfo = changeinfos.get(str(changelist))
+            if not changeinfo:
+                raise Exception('Changelist %s does not contain any shelved files.' % changelist)
+            if 'depotFile' not in changeinfo:
+                raise Exception('Changelist %s does not contain any shelved files' % changelist)
+            actions = changeinfo.get('action') or [''] * len(changeinfo['depotFile'])
+            for depotfile, action in zip(changeinfo['depotFile'], actions):
+                # Later shelves are stacked on top of earlier ones
+                depot_to_change[depotfile] = (changelist, action)
 
-        whereinfo = self.perforce.run_where(depotfiles)
+        whereinfo = reader.run_where(list(depot_to_change))
         depot_to_local = {item['depotFile']: item['path'] for item in whereinfo}
 
         # Flag these files as modified
         self._write_patched(list(depot_to_local.values()))
+        self._invalidate_bless_version()
+        self.manifest.resume(self.havetable.revision)
 
         # Turn sync spec info a prefix to filter out unwanted files
         # e.g. //my-depot/dir/... => //my-depot/dir/
@@ -334,22 +908,118 @@ class P4Repo:
             if os.path.isfile(localfile):
                 os.chmod(localfile, stat.S_IWRITE)
                 os.unlink(localfile)
+            changelist, action = depot_to_change[depotfile]
+            self.manifest.write({'depotFile': depotfile, 'path': localfile, 'action': 'unshelved',
+                                 'change': changelist, 'shelvedAction': action})
+            if action in ('delete', 'move/delete'):
+                continue # Nothing to print, the file is removed
             if any(depotfile.startswith(prefix) for prefix in sync_prefixes):
                 cmds.append(('print', '-o', localfile, '%s@=%s' % (depotfile, changelist)))
 
-        self.run_parallel_cmds(cmds)
+        with self.manifest:
+            self.run_parallel_cmds(cmds, server=reader)
+
+
+class ChangeManifest:
+    """JSON-lines record of files changed in the workspace, for incremental downstream builds
+
+    The first line describes the checkout, e.g. {"previous": "@5", "revision": "@9", "fresh": false},
+    followed by one line per changed file. Each phase which changes files ends with {"complete": true},
+    so a manifest without it as the last line was interrupted and is not trustworthy.
+    Batches synced between jobs add to the manifest after a {"background": "@12"} line, and the next
+    manifest carries their files over, so that it covers everything changed since the previous job.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.outfile = None
+        self._lock = threading.Lock()
+
+    def start(self, previous, revision, fresh=False):
+        """Begin a new manifest, including files synced by background batches since the last one"""
+        carried, previous = self._background_records(previous)
+        self._open('w')
+        self.write({'previous': previous, 'revision': revision, 'fresh': fresh})
+        for record in carried:
+            self.write(record)
+
+    def start_background(self, revision):
+        """Continue the existing manifest with a batch synced between jobs"""
+        self.resume(revision)
+        self.write({'background': revision})
+
+    def _background_records(self, previous):
+        """Get (file records, revision of the last job) if background batches added to the manifest"""
+        if not os.path.exists(self.path):
+            return [], previous
+        records, header, background = [], None, False
+        with open(self.path) as infile:
+            for line in infile:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # Partially written line of an interrupted batch
+                if header is None:
+                    header = record
+                elif 'background' in record:
+                    background = True
+                elif background and 'complete' not in record:
+                    records.append(record)
+        if not background:
+            return [], previous
+        return records, header.get('revision', previous)
+
+    def resume(self, revision):
+        """Continue the existing manifest, e.g. with files unshelved after the sync"""
+        if not os.path.exists(self.path):
+            self.start(previous=revision, revision=revision)
+            return
+        self._open('a')
+
+    def _open(self, mode):
+        self.close()
+        # Line buffered, so that builds can follow the manifest while files are synced
+        self.outfile = open(self.path, mode, buffering=1)
+
+    def write(self, record):
+        """Add a line to the manifest"""
+        with self._lock:
+            self.outfile.write(json.dumps(record) + '\n')
+
+    def close(self):
+        """Close the manifest file, if open"""
+        if self.outfile is not None:
+            self.outfile.close()
+            self.outfile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.write({'complete': True})
+        self.close()
 
 
 class SyncOutput(OutputHandler):
     """Log each synced file"""
-    def __init__(self, logger):
+    def __init__(self, logger, havetable=None, manifest=None):
         OutputHandler.__init__(self)
         self.logger = logger
+        self.havetable = havetable
+        self.manifest = manifest
         self.sync_count = 0
+        self.transferred = 0 # bytes
 
     def outputStat(self, stat):
         if 'depotFile' in stat:
+            if self.havetable is not None:
+                self.havetable.update_from_stat(stat)
+            if self.manifest is not None:
+                self.manifest.write({'depotFile': stat['depotFile'], 'path': stat.get('clientFile'),
+                                     'rev': stat.get('rev'), 'action': stat.get('action')})
             self.sync_count  += 1
+            if stat.get('action') != 'deleted':
+                self.transferred += int(stat.get('fileSize', 0))
             if self.sync_count < 1000:
                 # Normal, verbose logging of synced file
                 self.logger.info("%(depotFile)s#%(rev)s %(action)s" % stat)
@@ -359,6 +1029,33 @@ class SyncOutput(OutputHandler):
         return OutputHandler.REPORT
 
 
+def changelist_number(revision):
+    """Get the changelist number from a @<changelist> revision specifier, if it is one"""
+    if revision and revision.startswith('@') and revision[1:].isdigit():
+        return int(revision[1:])
+    return None
+
+def view_depot_paths(view, skip_exclusions=False):
+    """Get the depot side of each line in a client view
+
+    Returns None if the view contains exclusion lines, since changes to excluded files
+    would be reported when querying the remaining depot paths individually.
+    skip_exclusions: Leave out exclusion lines instead, where reporting those changes is acceptable.
+    """
+    depot_paths = []
+    for mapping in view:
+        depot_path = shlex.split(mapping)[0]
+        if depot_path.startswith('-'):
+            if skip_exclusions:
+                continue
+            return None
+        depot_paths.append(depot_path.lstrip('+&'))
+    return depot_paths
+
+def bless_checksum(blessed_version_string):
+    """Checksum line for a bless version file"""
+    return 'sha256:%s' % hashlib.sha256(blessed_version_string.encode('utf-8')).hexdigest()
+
 def sizeof_fmt(num, suffix='B'):
     """Format bytes to human readable value"""
     for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti']:
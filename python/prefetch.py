@@ -0,0 +1,154 @@
+"""
+Optional per-host daemon which syncs idle stream workspaces towards head between jobs,
+so that the next checkout only has a small delta left to sync.
+
+Run one instance per agent host, e.g.
+    python prefetch.py --builds-dir /var/lib/buildkite-agent/builds
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+
+from P4 import P4, P4Exception # pylint: disable=import-error
+
+from perforce import P4Repo
+from workspace import WorkspaceLock, active_jobs, load_settings
+
+logger = logging.getLogger("p4python")
+
+
+def find_workspaces(builds_dir, max_depth=5):
+    """Find workspace roots by their p4config file"""
+    builds_dir = os.path.abspath(builds_dir)
+    base_depth = builds_dir.rstrip(os.sep).count(os.sep)
+    for root, dirs, files in os.walk(builds_dir):
+        if 'p4config' in files:
+            dirs[:] = [] # Do not descend into workspaces
+            yield root
+        elif root.count(os.sep) - base_depth >= max_depth:
+            dirs[:] = []
+        else:
+            dirs[:] = [name for name in dirs if not name.startswith('.')]
+
+
+def read_p4config(root):
+    """Read settings from a p4config written by a previous checkout"""
+    config = {}
+    with open(os.path.join(root, 'p4config')) as infile:
+        for line in infile.read().splitlines():
+            if '=' in line:
+                key, value = line.split('=', 1)
+                config[key] = value
+    return config
+
+
+class Prefetcher:
+    """Keeps idle workspaces close to head in small, throttled batches"""
+    def __init__(self, builds_dir, batch_size=1000, pause=5, stale_after=24 * 60 * 60):
+        """
+        builds_dir: Directory to search for workspaces, usually the agent's build-path
+        batch_size: Maximum files to sync while holding the workspace lock
+        pause: Seconds to wait between batches, to throttle load on the server
+        stale_after: Seconds after which a job that never finished no longer blocks prefetch
+        """
+        self.builds_dir = builds_dir
+        self.batch_size = batch_size
+        self.pause = pause
+        self.stale_after = stale_after
+        self.counters = {} # (P4PORT, P4USER) => connection used to watch the change counter
+        self.synced_at = {} # workspace root => change counter when last brought up to date
+
+    def _change_counter(self, port, user):
+        """Get the latest changelist number on a server, a cheap query used to skip idle cycles"""
+        key = (port, user)
+        if key not in self.counters:
+            perforce = P4()
+            perforce.port = port
+            perforce.user = user
+            perforce.exception_level = 1
+            perforce.connect()
+            self.counters[key] = perforce
+        return self.counters[key].run_counter('change')[0]['value']
+
+    def _is_idle(self, root):
+        return not active_jobs(root, self.stale_after)
+
+    def run_once(self):
+        """Bring every idle stream workspace up to date"""
+        for root in find_workspaces(self.builds_dir):
+            try:
+                self.prefetch(root)
+            except P4Exception as ex:
+                logger.warning("prefetch of %s failed: %s" % (root, ex))
+
+    def prefetch(self, root):
+        """Sync one workspace towards head while no job is using it"""
+        config = read_p4config(root)
+        port, user, client = config.get('P4PORT'), config.get('P4USER'), config.get('P4CLIENT')
+        if not (port and user and client):
+            return
+        counter = self._change_counter(port, user)
+        if self.synced_at.get(root) == counter or not self._is_idle(root):
+            return
+
+        settings = load_settings(root)
+        if settings is None:
+            self.synced_at[root] = counter # Unknown which paths jobs sync here
+            return
+
+        os.environ.update({'P4PORT': port, 'P4USER': user})
+        with P4Repo(root=root, sync=settings['sync'], client_type=settings['client_type']) as repo:
+            repo.attach_client(client)
+            repo.stream = repo.perforce.fetch_client(client).get('Stream')
+            if not repo.stream:
+                self.synced_at[root] = counter # Only stream workspaces are prefetched
+                return
+            head = repo.head_at_revision('//%s/...' % client)
+            if not head or repo.havetable.revision == '@%s' % head:
+                self.synced_at[root] = counter
+                return
+
+            logger.info("prefetching %s to @%s" % (root, head))
+            lock = WorkspaceLock(root)
+            while True:
+                if not lock.acquire(blocking=False):
+                    return # A checkout is running
+                try:
+                    if not self._is_idle(root):
+                        return
+                    synced = repo.sync(revision='@%s' % head, max_files=self.batch_size)
+                finally:
+                    lock.release()
+                if len(synced) < self.batch_size:
+                    break
+                time.sleep(self.pause)
+            self.synced_at[root] = counter
+
+
+def main():
+    """Run the prefetch daemon"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--builds-dir', default=os.environ.get('BUILDKITE_BUILD_PATH'),
+                        help='Directory containing workspaces, defaults to $BUILDKITE_BUILD_PATH')
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between checks for new changes')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Files to sync per batch')
+    parser.add_argument('--pause', type=float, default=5, help='Seconds to wait between batches')
+    parser.add_argument('--once', action='store_true', help='Run a single pass then exit')
+    args = parser.parse_args()
+    if not args.builds_dir:
+        parser.error('--builds-dir is required when BUILDKITE_BUILD_PATH is not set')
+
+    if hasattr(os, 'nice'):
+        os.nice(10) # Never compete with jobs for CPU
+    prefetcher = Prefetcher(args.builds_dir, args.batch_size, args.pause)
+    while True:
+        prefetcher.run_once()
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
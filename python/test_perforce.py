@@ -4,16 +4,30 @@ Test perforce module for managing workspaces
 from contextlib import closing, contextmanager
 from functools import partial
 from threading import Thread
+import json
+import logging
 import os
 import shutil
 import socket
+import sqlite3
 import subprocess
 import tempfile
 import time
 import zipfile
 import pytest
 
+from P4 import P4, P4Exception # pylint: disable=import-error
 from perforce import P4Repo
+import history as history_module
+from history import CheckoutHistory, percentile
+from havetable import HaveTable
+from prefetch import Prefetcher
+from tracking import parse_track_output
+from checkout_server import CheckoutServer
+from checkout_client import request_checkout
+from checkout import checkout_workspace, checkout_metadata, run_checkout
+from buildkite import get_config
+from workspace import WorkspaceLock, mark_job, clear_job, wait_ready, active_jobs
 
 def find_free_port():
     """Find an open port that we could run a perforce server on"""
@@ -24,11 +38,10 @@ def find_free_port():
         return sock.getsockname()[1]
 
 @contextmanager
-def run_p4d(p4port, from_zip=None):
+def run_p4d(p4port, from_zip=None, prefix='bk-p4d-test-'):
     """Start a perforce server with the given hostname:port.
        Optionally unzip server state from a file
     """
-    prefix = 'bk-p4d-test-'
     parent = tempfile.gettempdir()
     for item in os.listdir(parent):
         if item.startswith(prefix):
@@ -202,6 +215,46 @@ def test_head(server, tmpdir):
 
     assert repo.head_at_revision("@my-label") == "2", "Unexpected HEAD revision for label"
 
+def test_head_multiple_view_lines(server, tmpdir, monkeypatch):
+    """Test resolve of HEAD changelist by querying each view line concurrently"""
+    repo = P4Repo(root=tmpdir, view=['//depot/... depot/...', '//stream-depot/dev/... dev/...'])
+    assert repo.head() == "@8", "Unexpected HEAD revision for multiple view lines"
+    assert repo.head() == '@' + repo.head_at_revision('//%s/...' % repo.perforce.client)
+
+    # The view saved while setting up the client is used, rather than fetching the spec again
+    repo = P4Repo(root=tmpdir, view=['//depot/... depot/...', '//stream-depot/dev/... dev/...'])
+    fetched = []
+    def fetch_client(self, *args):
+        fetched.append(args)
+        return self.run('client', '-o', *args)[0]
+    with monkeypatch.context() as patch:
+        patch.setattr(P4, 'fetch_client', fetch_client, raising=False)
+        assert repo.head() == "@8"
+    assert len(fetched) == 1, "Client spec should only be fetched by setup"
+
+    repo = P4Repo(root=tmpdir, view=['//depot/... depot/...', '-//depot/file.txt depot/file.txt'])
+    assert repo.head() == '@' + repo.head_at_revision('//%s/...' % repo.perforce.client)
+
+    # Label lookups are cached
+    assert repo.head_at_revision("@my-label") == "2"
+    def no_server(*args):
+        raise AssertionError("Label revision should be cached")
+    monkeypatch.setattr(P4, 'fetch_label', no_server, raising=False)
+    assert repo.head_at_revision("@my-label") == "2"
+
+def test_head_without_client(server, tmpdir):
+    """Test resolving head and description without creating a client workspace"""
+    repo = P4Repo(root=tmpdir, stream='//stream-depot/main')
+    assert repo.head_without_client() == '@9'
+    repo = P4Repo(root=tmpdir, stream='//stream-depot/dev')
+    assert repo.head_without_client() == '@8'
+    repo = P4Repo(root=tmpdir, view=['//depot/... ...'])
+    assert checkout_metadata(repo, None, []) == ('@6', 'modify //depot/file.txt\n')
+    assert checkout_metadata(repo, None, ['5']) == ('@6', 'Add file in shelved change\n')
+    assert repo.perforce.run_clients('-e', repo._get_clientname()) == [], \
+        "No client should be created" # pylint: disable=protected-access
+    assert os.listdir(tmpdir) == []
+
 def test_checkout(server, tmpdir):
     """Test normal flow of checking out files"""
     repo = P4Repo(root=tmpdir)
@@ -209,7 +262,7 @@ def test_checkout(server, tmpdir):
     assert os.listdir(tmpdir) == [], "Workspace should be empty"
     repo.sync()
     assert sorted(os.listdir(tmpdir)) == sorted([
-        "file.txt", "p4config"]), "Workspace sync not as expected"
+        "file.txt", "p4config", "have.json", "manifest.jsonl"]), "Workspace sync not as expected"
     with open(os.path.join(tmpdir, "file.txt")) as content:
         assert content.read() == "Hello World\n", "Unexpected content in workspace file"
 
@@ -220,6 +273,443 @@ def test_checkout(server, tmpdir):
     with open(os.path.join(tmpdir, "p4config")) as content:
         assert "P4PORT=%s\n" % repo.perforce.port in content.readlines(), "Unexpected p4config content"
 
+def test_have_table_mirror(server, tmpdir, monkeypatch):
+    """Test the have table is mirrored to disk and kept up to date by syncs"""
+    repo = P4Repo(root=tmpdir, stream='//stream-depot/main')
+    repo.sync()
+    server_have = {item['depotFile']: item['haveRev'] for item in repo.perforce.run_have()}
+    assert {item['depotFile']: item['haveRev'] for item in repo.have()} == server_have
+    assert [item['depotFile'] for item in repo.have('//stream-depot/main/file_2...')] == [
+        '//stream-depot/main/file_2.txt']
+
+    # Mirror is re-used by later jobs without asking the server, or rewriting it when nothing changed
+    repo = P4Repo(root=tmpdir, stream='//stream-depot/main')
+    with monkeypatch.context() as patch:
+        def no_server(*args):
+            raise AssertionError("Have table mirror should not query the server")
+        def no_save(*args):
+            raise AssertionError("Unchanged have table mirror should not be saved")
+        patch.setattr(P4, 'run_have', no_server, raising=False)
+        patch.setattr(HaveTable, 'save', no_save)
+        assert {item['depotFile']: item['haveRev'] for item in repo.have()} == server_have
+
+    repo = P4Repo(root=tmpdir, stream='//stream-depot/main')
+    repo.sync(revision='@0')
+    assert repo.have() == []
+
+    # Missing or corrupt mirrors are rebuilt from the server when needed, but not to sync
+    repo.sync()
+    with open(os.path.join(tmpdir, 'have.json'), 'w') as havefile:
+        havefile.write('{"client": ')
+    repo = P4Repo(root=tmpdir, stream='//stream-depot/main')
+    with monkeypatch.context() as patch:
+        patch.setattr(P4, 'run_have', no_server, raising=False)
+        repo.sync()
+    assert not repo.sync_stats['fresh']
+    assert not os.path.exists(os.path.join(tmpdir, 'have.json')), "Incomplete mirror was saved"
+    assert {item['depotFile']: item['haveRev'] for item in repo.have()} == server_have
+
+def test_checkout_history(server, tmpdir):
+    """Test past checkouts are used to choose sync settings"""
+    history = CheckoutHistory(os.path.join(tmpdir, 'history.sqlite'))
+    root = os.path.join(tmpdir, 'workspace')
+
+    # Untried parallel settings are explored first
+    repo = P4Repo(root=root, parallel='auto', history=history)
+    repo.sync()
+    assert repo.sync_stats['parallel'] == 0
+    assert repo.sync_stats['fresh']
+    history.record(workspace=repo.history_key(), success=True, **repo.sync_stats)
+
+    # Then the setting with the best transfer rate is chosen
+    for parallel, rate in [(0, 10), (4, 40), (8, 20), (16, 30)] * 3:
+        history.record(workspace=repo.history_key(), success=True, parallel=parallel,
+                       bytes=rate * 1000, sync_seconds=1000.0)
+    repo = P4Repo(root=root, parallel='auto', history=history)
+    repo.sync()
+    assert repo.sync_stats['parallel'] == 4
+    assert not repo.sync_stats['fresh']
+
+    # Large changelist deltas prefer a fresh workspace when history shows it is faster
+    for _ in range(3):
+        history.record(workspace=repo.history_key(), success=True, fresh=True, sync_seconds=10.0)
+        history.record(workspace=repo.history_key(), success=True, fresh=False,
+                       from_change=1, to_change=2, sync_seconds=5.0)
+    assert not history.prefer_fresh(repo.history_key(), 1)
+    assert history.prefer_fresh(repo.history_key(), 5)
+    repo = P4Repo(root=root, history=history)
+    repo.sync(revision='@1')
+    open(os.path.join(root, 'untracked.txt'), 'a').close()
+    repo.sync(revision='@6')
+    assert repo.sync_stats['fresh']
+    assert 'untracked.txt' not in os.listdir(root)
+
+    assert [row['workspace'] for row in history.rows(success=None)][0] == '//...'
+    history.close()
+
+def test_checkout_history_unreachable(tmpdir, monkeypatch):
+    """Test checkouts which cannot reach the server are recorded as failures"""
+    monkeypatch.setenv('P4PORT', 'localhost:%s' % find_free_port())
+    monkeypatch.delenv('BUILDKITE_JOB_ID', raising=False)
+    history = CheckoutHistory(os.path.join(tmpdir, 'history.sqlite'))
+    repo = P4Repo(root=os.path.join(tmpdir, 'workspace'))
+    with pytest.raises(P4Exception, match='Connect to server failed'):
+        run_checkout(repo, history, '@1', [])
+    assert [row['success'] for row in history.rows(success=None)] == [0]
+    history.close()
+
+def test_adaptive_bandwidth(server, tmpdir):
+    """Test compression and parallel sync are enabled when history shows a slow link"""
+    history = CheckoutHistory(os.path.join(tmpdir, 'history.sqlite'))
+    root = os.path.join(tmpdir, 'workspace')
+
+    for _ in range(3):
+        history.record(workspace='//depot/...', success=True, transfer_rate=100 * 1024 * 1024, compress=False,
+                       port=server)
+    repo = P4Repo(root=root, history=history, bandwidth='auto')
+    repo.sync(revision='@1')
+    assert 'nocompress' in repo.perforce.fetch_client(repo.perforce.client)['Options']
+    assert repo.sync_stats['parallel'] == 0
+    assert not repo.sync_stats['compress']
+
+    for _ in range(6):
+        history.record(workspace='//depot/...', success=True, transfer_rate=512 * 1024, compress=False, port=server)
+    repo = P4Repo(root=root, history=history, bandwidth='auto')
+    repo.sync(revision='@6')
+    assert ' compress' in repo.perforce.fetch_client(repo.perforce.client)['Options']
+    assert repo.sync_stats['parallel'] == 8
+    assert repo.sync_stats['compress']
+
+    # Compressed syncs do not change the measured link rate
+    history.record(workspace='//depot/...', success=True, transfer_rate=100 * 1024 * 1024, compress=True,
+                   port=server)
+    assert history.link_rate(server) == 512 * 1024
+
+    # Only recent syncs from the same server count, so a compressed link is measured again
+    for _ in range(3):
+        history.record(workspace='//depot/...', success=True, transfer_rate=1024, compress=False, port='replica:1666')
+    assert history.link_rate(server) == 512 * 1024
+    assert history.link_rate('replica:1666') == 1024
+    history.conn.execute('UPDATE checkouts SET time = 0')
+    assert history.link_rate(server) is None
+
+    # Explicit settings win
+    repo = P4Repo(root=root, history=history, bandwidth='auto', client_options='nocompress', parallel=2)
+    repo.sync(revision='@6')
+    assert 'nocompress' in repo.perforce.fetch_client(repo.perforce.client)['Options']
+    assert repo.sync_stats['parallel'] == 2
+    history.close()
+
+def test_history_migration(tmpdir):
+    """Test history databases from older versions gain new columns"""
+    path = os.path.join(tmpdir, 'history.sqlite')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE checkouts (id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL NOT NULL,'
+                 ' workspace TEXT NOT NULL, client TEXT, success INTEGER NOT NULL, fresh INTEGER,'
+                 ' from_change INTEGER, to_change INTEGER, files INTEGER, bytes INTEGER, parallel INTEGER,'
+                 ' head_seconds REAL, sync_seconds REAL, unshelve_seconds REAL, total_seconds REAL)')
+    conn.execute("INSERT INTO checkouts (time, workspace, success) VALUES (1, '//...', 1)")
+    conn.commit()
+    conn.close()
+
+    history = CheckoutHistory(path)
+    history.record(workspace='//...', success=True, transfer_rate=1.0, compress=False, port='perforce:1666')
+    assert [row['transfer_rate'] for row in history.rows()] == [None, 1.0]
+    assert history.link_rate('perforce:1666') is None
+    history.close()
+
+def test_history_limits(tmpdir, monkeypatch):
+    """Test percentiles are nearest-rank and history is bounded"""
+    assert percentile([1, 2, 3, 4, 5], 50) == 3
+    assert percentile([1, 2, 3, 4, 5], 90) == 5
+    assert percentile([1, 2, 3, 4, 5], 0) == 1
+
+    monkeypatch.setattr(history_module, '__MAX_ROWS__', 5)
+    history = CheckoutHistory(os.path.join(tmpdir, 'history.sqlite'))
+    for index in range(8):
+        history.record(workspace='//...', success=True, time=index, files=index)
+    assert [row['files'] for row in history.rows()] == [3, 4, 5, 6, 7]
+    assert [row['files'] for row in history.rows(limit=2)] == [6, 7]
+    history.close()
+
+def test_prefetch(server, tmpdir):
+    """Test idle workspaces are synced forward in the background"""
+    root = os.path.join(tmpdir, 'workspace')
+    repo = P4Repo(root=root, stream='//stream-depot/main')
+    repo.sync(revision='@2')
+    assert 'file_2.txt' not in os.listdir(root)
+
+    prefetcher = Prefetcher(builds_dir=tmpdir, batch_size=1, pause=0)
+
+    # Workspaces in use by a job or locked by a checkout are left alone
+    mark_job(root, 'job-1')
+    prefetcher.run_once()
+    assert 'file_2.txt' not in os.listdir(root)
+    clear_job(root, 'job-1')
+    with WorkspaceLock(root):
+        prefetcher.run_once()
+    assert 'file_2.txt' not in os.listdir(root)
+
+    prefetcher.run_once()
+    assert 'file_2.txt' in os.listdir(root)
+    repo = P4Repo(root=root, stream='//stream-depot/main')
+    assert repo.sync(revision='@9') == [], "Workspace should already be at head"
+    manifest = read_manifest(root)
+    assert manifest[0]['previous'] == '@2', "Manifest should cover changes since the last job"
+    assert 'file_2.txt' in [os.path.basename(record.get('path', '')) for record in manifest]
+
+    # Only the paths jobs sync in a workspace are prefetched
+    partial_root = os.path.join(tmpdir, 'partial')
+    repo = P4Repo(root=partial_root, stream='//stream-depot/main', sync=['//stream-depot/main/file.txt'])
+    repo.sync(revision='@2')
+    prefetcher.run_once()
+    assert 'file_2.txt' not in os.listdir(partial_root)
+
+def test_server_tracking(server, tmpdir):
+    """Test server performance tracking is aggregated per command"""
+    repo = P4Repo(root=tmpdir, view=['//depot/... depot/...', '//stream-depot/dev/... dev/...'], track=True)
+    repo.head() # Runs changes on parallel connections
+    repo.sync()
+    assert repo.tracking.commands['sync']['count'] == 1
+    assert repo.tracking.commands['changes']['count'] == 2
+    assert 'sync x1' in repo.tracking.summary()
+
+    assert parse_track_output([
+        '--- lapse .044s',
+        '--- rpc msgs/size in+out 2+3/0mb+0mb himarks 97200/318788 snd/rcv .010s/.002s',
+        '--- db.have',
+        '---   pages in+out+cached 3+1+2',
+        '---   locks read/write 1/0 rows get+pos+scan put+del 0+1+2 0+0',
+        '---   total lock wait+held read/write 5ms+1ms/2ms+3ms',
+    ]) == {'lapse': 0.044, 'rpc': 0.012, 'lock_wait': 7, 'lock_held': 4, 'db_pages': 4}
+
+def read_manifest(root):
+    """Read the changed files manifest from a workspace"""
+    with open(os.path.join(root, "manifest.jsonl")) as manifest:
+        return [json.loads(line) for line in manifest]
+
+def test_manifest(server, tmpdir):
+    """Test changed files are streamed to a manifest for incremental builds"""
+    repo = P4Repo(root=tmpdir)
+    repo.sync(revision='@1')
+    manifest = read_manifest(tmpdir)
+    assert manifest[0] == {'previous': None, 'revision': '@1', 'fresh': True}
+    assert manifest[1]['depotFile'] == '//depot/file.txt'
+    assert manifest[1]['path'] == os.path.join(tmpdir, 'file.txt')
+    assert manifest[-1] == {'complete': True}
+
+    repo.sync(revision='@6')
+    repo.p4print_unshelve('5')
+    manifest = read_manifest(tmpdir)
+    assert manifest[0] == {'previous': '@1', 'revision': '@6', 'fresh': False}
+    assert [(line.get('depotFile'), line.get('action')) for line in manifest[1:]] == [
+        ('//depot/file.txt', 'updated'),
+        (None, None), # complete
+        ('//depot/newfile.txt', 'unshelved'),
+        (None, None), # complete
+    ]
+
+    # Files restored after an unshelve are reported as changed
+    repo.sync(revision='@6')
+    manifest = read_manifest(tmpdir)
+    assert manifest[1] == {'path': os.path.join(tmpdir, 'newfile.txt'), 'action': 'reverted'}
+
+def test_priority_sync(server, tmpdir):
+    """Test priority paths are synced and marked ready before the rest of the workspace"""
+    root = os.path.join(tmpdir, 'workspace')
+    repo = P4Repo(root=root, stream='//stream-depot/main', priority=['//stream-depot/main/file.txt'])
+    repo.sync(revision='@9', defer=True)
+    assert 'file.txt' in os.listdir(root)
+    assert 'file_2.txt' not in os.listdir(root)
+    wait_ready(root, ['//stream-depot/main/file.txt'], timeout=0)
+    with pytest.raises(Exception, match='Timed out'):
+        wait_ready(root, ['//stream-depot/main/file_2.txt'], timeout=0)
+    assert read_manifest(root)[-1] != {'complete': True}
+
+    # The build runs while the rest of the workspace syncs, files it opened must stay open
+    repo = P4Repo(root=root, stream='//stream-depot/main', priority=['//stream-depot/main/file.txt'])
+    opened = P4()
+    opened.client = repo._get_clientname() # pylint: disable=protected-access
+    opened.exception_level = 1
+    opened.connect()
+    opened.run_trust('-y')
+    opened.run_edit('//stream-depot/main/file.txt')
+    repo.finish_sync(revision='@9')
+    assert opened.run_opened(), "Background sync reverted files opened by the build"
+    opened.run_revert('//...')
+    opened.disconnect()
+    assert 'file_2.txt' in os.listdir(root)
+    wait_ready(root, ['//stream-depot/main/file_2.txt'], timeout=0)
+    assert read_manifest(root)[-1] == {'complete': True}
+    assert repo.sync(revision='@9') == [], "Workspace should already be at head"
+
+def test_checkout_server(server, tmpdir):
+    """Test checkouts served by a long running process reuse its repo"""
+    socket_path = os.path.join(tmpdir, 'checkout.sock')
+    checkout_server = CheckoutServer(socket_path)
+    thread = Thread(target=checkout_server.serve_forever, daemon=True)
+    thread.start()
+
+    root = os.path.join(tmpdir, 'workspace')
+    request = {
+        'env': dict(os.environ),
+        'config': {'root': root, 'stream': '//stream-depot/main'},
+        'revision': None,
+        'changelists': [],
+        'background_sync': False,
+        'shared': False,
+        'mode': 'sync',
+    }
+    try:
+        for revision in ['@2', None]:
+            with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as conn:
+                conn.connect(socket_path)
+                result = request_checkout(conn, dict(request, revision=revision))
+            assert result['root'] == root
+        assert result['revision'] == '@9'
+        assert 'file_2.txt' in os.listdir(root)
+        assert len(checkout_server.workers) == 1, "Checkouts for an agent should be run by one worker"
+
+        # Other agents are served by their own worker, while a checkout for this agent runs
+        other = dict(request, env=dict(os.environ, BUILDKITE_AGENT_NAME='other-agent'), mode='metadata')
+        def metadata_checkout():
+            with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as conn:
+                conn.connect(socket_path)
+                assert request_checkout(conn, other)['revision'] == '@9'
+        with checkout_server.worker(request['env'].get('BUILDKITE_AGENT_NAME', '')).lock:
+            other_thread = Thread(target=metadata_checkout)
+            other_thread.start()
+            other_thread.join(timeout=60)
+            assert not other_thread.is_alive(), "Checkout for another agent waited for this agent"
+        assert len(checkout_server.workers) == 2
+
+        # A removed workspace is set up again
+        shutil.rmtree(root)
+        with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as conn:
+            conn.connect(socket_path)
+            request_checkout(conn, request)
+        assert 'file_2.txt' in os.listdir(root)
+    finally:
+        checkout_server.shutdown()
+        checkout_server.server_close()
+
+def test_refresh_after_client_changed(server, tmpdir):
+    """Test a reused repo sets its client up again after another configuration changed it"""
+    main = P4Repo(root=tmpdir, stream='//stream-depot/main')
+    main.sync()
+    dev = P4Repo(root=tmpdir, stream='//stream-depot/dev')
+    dev.sync()
+    assert 'file_2.txt' not in os.listdir(tmpdir)
+
+    main.refresh()
+    main.sync()
+    assert main.perforce.fetch_client(main.perforce.client)['Stream'] == '//stream-depot/main'
+    assert 'file_2.txt' in os.listdir(tmpdir)
+
+def test_replica(server, tmpdir, monkeypatch):
+    """Test read-only commands go to a replica unless it is behind the requested changelist"""
+    replica_port = 'ssl:localhost:%s' % find_free_port()
+    with run_p4d(replica_port, from_zip='server.zip', prefix='bk-p4d-replica-test-'):
+        time.sleep(1)
+        repo = P4Repo(root=tmpdir, replica=replica_port)
+
+        # A replica which has not replayed the new client spec yet is not used
+        repo.sync(revision='@6')
+        assert repo.sync_stats['port'] == repo.perforce.port
+        assert [item['depotFile'] for item in repo.perforce.run_have()] == ['//depot/file.txt']
+
+        # Client specs are replicated from the primary in a real deployment
+        replica = P4()
+        replica.port = replica_port
+        replica.exception_level = 1
+        replica.connect()
+        replica.run_trust('-y')
+        replica.save_client(repo.perforce.fetch_client(repo.perforce.client))
+        replica.client = repo.perforce.client
+
+        repo.sync(revision='@6')
+        assert repo.sync_stats['port'] == replica_port
+        assert [item['depotFile'] for item in replica.run_have()] == ['//depot/file.txt']
+        assert repo.description('6') == 'modify //depot/file.txt\n'
+
+        # A replica which lags behind the changelist is not used
+        monkeypatch.setattr(P4, 'run_counter', lambda self, *args: [{'value': '5'}], raising=False)
+        repo.sync(revision='@6')
+        assert repo.sync_stats['port'] == repo.perforce.port
+        replica.disconnect()
+
+def test_replica_fingerprint(server, tmpdir):
+    """Test a replica whose fingerprint does not match is not used"""
+    os.environ['P4TRUST'] = os.path.join(tmpdir, 'trust.txt')
+    replica_port = 'ssl:localhost:%s' % find_free_port()
+    with run_p4d(replica_port, from_zip='server.zip', prefix='bk-p4d-replica-test-'):
+        time.sleep(1)
+        repo = P4Repo(root=os.path.join(tmpdir, 'workspace'), replica=replica_port,
+                      fingerprint=__LEGIT_P4_FINGERPRINT__,
+                      replica_fingerprint='FF:FF:FF:FF:FF:FF:FF:FF:FF:FF:FF:FF:FF:FF:FF:FF:FF:FF:FF:FF')
+        repo.sync(revision='@6')
+        assert [item['depotFile'] for item in repo.perforce.run_have()] == ['//depot/file.txt']
+
+def test_shared_workspace(server, tmpdir, monkeypatch):
+    """Test jobs share a workspace at the same revision, and busy workspaces are not changed"""
+    root = os.path.join(tmpdir, 'shared')
+    config = {'root': root, 'stream': '//stream-depot/main', 'host_client': True}
+    def checkout(job_id, revision, user_changelists=()):
+        monkeypatch.setenv('BUILDKITE_JOB_ID', job_id)
+        return checkout_workspace(lambda config: P4Repo(**config), config, None, revision,
+                                  list(user_changelists), shared=True, shared_timeout=0)
+
+    assert checkout('job-1', '@9')[3] == root
+
+    # Readers leave the workspace alone, including files opened by running jobs
+    opened = P4()
+    opened.client = P4Repo(**config)._get_clientname() # pylint: disable=protected-access
+    opened.exception_level = 1
+    opened.connect()
+    opened.run_trust('-y')
+    opened.run_edit('//stream-depot/main/file.txt')
+    assert checkout('job-2', '@9')[3] == root
+    assert opened.run_opened(), "Shared reader reverted files opened by another job"
+    opened.run_revert('//...')
+    opened.disconnect()
+    assert sorted(active_jobs(root)) == ['job-1', 'job-2']
+
+    # Syncing would change files under running jobs
+    _, _, _, overlay = checkout('job-3', '@2')
+    assert overlay != root
+    assert 'file_2.txt' not in os.listdir(overlay)
+    assert 'file_2.txt' in os.listdir(root)
+
+    # Once jobs have finished, the workspace can change
+    clear_job(root, 'job-1')
+    clear_job(root, 'job-2')
+    assert checkout('job-4', '@2')[3] == root
+    assert 'file_2.txt' not in os.listdir(root)
+
+    # Overlays which have not been checked out for a while are removed
+    clear_job(overlay, 'job-3')
+    os.utime(os.path.join(overlay, 'p4config'), (0, 0))
+    clear_job(root, 'job-4')
+    checkout('job-5', '@2')
+    assert not os.path.exists(overlay)
+
+def test_bootstrap(server, tmpdir):
+    """Test empty workspaces are populated by syncing chunks concurrently"""
+    repo = P4Repo(root=tmpdir, stream='//stream-depot/main', bootstrap=4)
+    repo.sync(revision='@9')
+    assert sorted(os.listdir(tmpdir)) == sorted([
+        "file.txt", "file_2.txt", "p4config", "have.json", "manifest.jsonl"])
+    assert repo.sync_stats['files'] == 2
+    assert [(record[0], record[1]) for record in repo.havetable.scan()] == [
+        ('//stream-depot/main/file.txt', 1), ('//stream-depot/main/file_2.txt', 1)]
+    assert [line.get('depotFile') for line in read_manifest(tmpdir)[1:]] == [
+        '//stream-depot/main/file.txt', '//stream-depot/main/file_2.txt', None]
+    assert repo.sync(revision='@9') == [], "Bootstrap should match a single sync"
+
+    # Only empty workspaces are bootstrapped
+    repo.sync(revision='@2')
+    assert 'file_2.txt' not in os.listdir(tmpdir)
+
 def test_checkout_partial_path(server, tmpdir):
     """Test checking out a subset of view with one path"""
     repo = P4Repo(root=tmpdir, sync=['//depot/file.txt'])
@@ -300,14 +790,14 @@ def test_workspace_recovery(server, tmpdir):
     open(os.path.join(tmpdir, "added.txt"), 'a').close()
     repo.clean()
     assert sorted(os.listdir(tmpdir)) == sorted([
-        "file.txt", "p4config"]), "Failed to restore workspace file with repo.clean()"
+        "file.txt", "p4config", "have.json"]), "Failed to restore workspace file with repo.clean()"
 
     os.remove(os.path.join(tmpdir, "file.txt"))
     os.remove(os.path.join(tmpdir, "p4config"))
     repo = P4Repo(root=tmpdir) # Open a fresh tmpdir, as if this was a different job
     repo.sync() # Normally: "You already have file.txt", but since p4config is missing it will restore the workspace
     assert sorted(os.listdir(tmpdir)) == sorted([
-        "file.txt", "p4config"]), "Failed to restore corrupt workspace due to missing p4config"
+        "file.txt", "p4config", "have.json", "manifest.jsonl"]), "Failed to restore corrupt workspace due to missing p4config"
 
 def test_p4print_unshelve(server, tmpdir):
     """Test unshelving a pending changelist by p4printing content into a file"""
@@ -348,6 +838,29 @@ def test_p4print_unshelve(server, tmpdir):
     repo.p4print_unshelve('3') # Modify a file
 
 
+def test_p4print_unshelve_stacked(server, tmpdir):
+    """Test unshelving several stacked changelists in a single pass"""
+    repo = P4Repo(root=tmpdir)
+    repo.sync()
+
+    repo.p4print_unshelve(['3', '5']) # Modify a file, then add a file
+    with open(os.path.join(tmpdir, "file.txt")) as content:
+        assert content.read() == "Goodbye World\n", "Unexpected content in workspace file"
+    assert os.path.exists(os.path.join(tmpdir, "newfile.txt"))
+    assert len(repo._read_patched()) == 2 # changes to file.txt and newfile.txt
+
+    repo.sync()
+    repo.p4print_unshelve(['3', '4']) # Topmost shelf deletes the modified file
+    assert not os.path.exists(os.path.join(tmpdir, "file.txt"))
+
+    repo.sync()
+    repo.p4print_unshelve(['4', '3']) # Topmost shelf modifies the deleted file
+    with open(os.path.join(tmpdir, "file.txt")) as content:
+        assert content.read() == "Goodbye World\n", "Unexpected content in workspace file"
+
+    with pytest.raises(Exception, match=r'Changelist 999 does not contain any shelved files.'):
+        repo.p4print_unshelve(['3', '999'])
+
 def copytree(src, dst):
     """Shim to get around shutil.copytree requiring root dir to not exist"""
     for item in os.listdir(src):
@@ -373,13 +886,42 @@ def test_client_migration(server, tmpdir):
         synced = repo.sync() # Flushes to match previous client, since p4config is there on disk
         assert synced == [], "Should not have synced any files in second client"
 
+def test_bless_version(server, tmpdir):
+    """Test readonly clients maintain bless.version to migrate without a full clean"""
+    repo = P4Repo(root=tmpdir, stream='//stream-depot/main', client_type='readonly')
+    repo.sync(revision='@9')
+    with open(os.path.join(tmpdir, "bless.version")) as content:
+        assert content.read().splitlines()[0] == "//stream-depot/main@9"
+
+    with tempfile.TemporaryDirectory(prefix="bk-p4-test-") as second_client:
+        copytree(tmpdir, second_client)
+        repo = P4Repo(root=second_client, stream='//stream-depot/main', client_type='readonly')
+        synced = repo.sync(revision='@9') # Flushes to blessed version instead of cleaning
+        assert synced == [], "Should not have synced any files in second client"
+
+    # Modified workspaces are not blessed
+    repo = P4Repo(root=tmpdir, stream='//stream-depot/main', client_type='readonly')
+    repo.p4print_unshelve('3')
+    assert not os.path.exists(os.path.join(tmpdir, "bless.version"))
+    repo.sync(revision='@9')
+    assert os.path.exists(os.path.join(tmpdir, "bless.version"))
+
+    # Tampered bless.version files are ignored
+    with open(os.path.join(tmpdir, "bless.version"), 'w') as content:
+        content.write("//stream-depot/main@2\nsha256:0000\n")
+    with tempfile.TemporaryDirectory(prefix="bk-p4-test-") as second_client:
+        copytree(tmpdir, second_client)
+        repo = P4Repo(root=second_client, stream='//stream-depot/main', client_type='readonly')
+        synced = repo.sync(revision='@9') # Full clean, then syncs everything
+        assert len(synced) > 0, "Should have synced files after a full clean"
+
 def test_stream_switching(server, tmpdir):
     """Test stream-switching within the same depot"""
     repo = P4Repo(root=tmpdir, stream='//stream-depot/main')
     synced = repo.sync()
     assert len(synced) > 0, "Didn't sync any files"
     assert set(os.listdir(tmpdir)) == set([
-        "file.txt", "file_2.txt", "p4config"])
+        "file.txt", "file_2.txt", "p4config", "have.json", "manifest.jsonl"])
     with open(os.path.join(tmpdir, "file.txt")) as content:
         assert content.read() == "Hello Stream World\n", "Unexpected content in workspace file"
 
@@ -388,7 +930,7 @@ def test_stream_switching(server, tmpdir):
     repo.sync()
     assert len(synced) > 0, "Didn't sync any files"
     assert set(os.listdir(tmpdir)) == set([
-        "file.txt", "p4config"]) # file_2.txt was de-synced
+        "file.txt", "p4config", "have.json", "manifest.jsonl"]) # file_2.txt was de-synced
     with open(os.path.join(tmpdir, "file.txt")) as content:
         assert content.read() == "Hello Stream World (dev)\n", "Unexpected content in workspace file"
 
@@ -398,7 +940,7 @@ def test_stream_switching_migration(server, tmpdir):
     synced = repo.sync()
     assert len(synced) > 0, "Didn't sync any files"
     assert set(os.listdir(tmpdir)) == set([
-        "file.txt", "file_2.txt", "p4config"])
+        "file.txt", "file_2.txt", "p4config", "have.json", "manifest.jsonl"])
     with open(os.path.join(tmpdir, "file.txt")) as content:
         assert content.read() == "Hello Stream World\n", "Unexpected content in workspace file"
 
@@ -410,10 +952,37 @@ def test_stream_switching_migration(server, tmpdir):
         repo.sync()
         assert len(synced) > 0, "Didn't sync any files"
         assert set(os.listdir(second_client)) == set([
-            "file.txt", "p4config"]) # file_2.txt was de-synced
+            "file.txt", "p4config", "have.json", "manifest.jsonl"]) # file_2.txt was de-synced
         with open(os.path.join(second_client, "file.txt")) as content:
             assert content.read() == "Hello Stream World (dev)\n", "Unexpected content in workspace file"
 
+def test_lazy_connection(server, tmpdir):
+    """Test that repos connect on first use, share one log handler and disconnect when closed"""
+    repos = [P4Repo(root=os.path.join(tmpdir, str(index))) for index in range(3)]
+    assert not any(repo.connected() for repo in repos), "Connected before first use"
+
+    with repos[0] as repo:
+        assert repo.info()['serverAddress']
+        assert repo.connected()
+        perforce = repo.perforce
+    assert not perforce.connected(), "Connection left open after leaving context"
+    assert not repo.connected()
+
+    handlers = list(logging.getLogger('p4python').handlers)
+    for repo in repos:
+        with repo:
+            repo.info()
+    assert logging.getLogger('p4python').handlers == handlers, "Each repo added a log handler"
+    assert not any(repo.connected() for repo in repos)
+
+    # Commands after closing run against the repo's client again
+    repo = P4Repo(root=os.path.join(tmpdir, 'reused'), stream='//stream-depot/main')
+    repo.sync()
+    client = repo.perforce.client
+    repo.close()
+    assert repo.sync() == []
+    assert repo.perforce.client == client
+
 # fingerprint here matches to the cert in the test fixture directory, and you can check that with
 # P4SSLDIR=$(pwd)/python/fixture/insecure-ssl p4d -Gf
 __LEGIT_P4_FINGERPRINT__ = '7A:10:F6:00:95:87:5B:2E:D4:33:AB:44:42:05:85:94:1C:93:2E:A2'
@@ -426,6 +995,15 @@ def test_fingerprint_good(server, tmpdir):
     synced = repo.sync()
     assert len(synced) > 0, "Didn't sync any files"
 
+def test_fingerprint_from_config(server, tmpdir, monkeypatch):
+    """Test the fingerprint setting of the plugin, which get_config reads as a list"""
+    monkeypatch.setenv('P4TRUST', os.path.join(tmpdir, 'trust.txt'))
+    monkeypatch.setenv('BUILDKITE_BUILD_CHECKOUT_PATH', str(tmpdir))
+    monkeypatch.setenv('BUILDKITE_PLUGIN_PERFORCE_FINGERPRINT', __LEGIT_P4_FINGERPRINT__)
+    with P4Repo(**get_config()) as repo:
+        synced = repo.sync()
+    assert len(synced) > 0, "Didn't sync any files"
+
 def test_fingerprint_bad(server, tmpdir):
     """Test supplying an incorrect fingerprint"""
     os.environ['P4TRUST'] = os.path.join(tmpdir, 'trust.txt')
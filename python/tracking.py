@@ -0,0 +1,101 @@
+"""
+Collect server performance tracking (p4 -Ztrack) for every p4 command
+"""
+import re
+import threading
+
+from P4 import P4 # pylint: disable=import-error
+
+__FIELDS__ = ['lapse', 'rpc', 'lock_wait', 'lock_held', 'db_pages']
+
+# e.g. "lapse .044s"
+__LAPSE__ = re.compile(r'^lapse (\d*\.?\d+)s')
+# e.g. "rpc msgs/size in+out 2+3/0mb+0mb himarks 97200/318788 snd/rcv .000s/.012s"
+__RPC__ = re.compile(r'^rpc .* snd/rcv (\d*\.?\d+)s/(\d*\.?\d+)s')
+# e.g. "total lock wait+held read/write 0ms+1ms/0ms+0ms"
+__LOCKS__ = re.compile(r'^total lock wait\+held read/write (\d+)ms\+(\d+)ms/(\d+)ms\+(\d+)ms')
+# e.g. "pages in+out+cached 3+0+2"
+__PAGES__ = re.compile(r'^pages in\+out\+cached (\d+)\+(\d+)')
+
+
+def parse_track_output(lines):
+    """Sum server time spent on a command from its tracking output
+
+    Returns seconds of lapse and rpc time, milliseconds of lock wait and hold
+    time across all db tables, and the number of db pages read and written.
+    """
+    totals = dict.fromkeys(__FIELDS__, 0.0)
+    for line in lines:
+        line = line.lstrip('- ')
+        match = __LAPSE__.match(line)
+        if match:
+            totals['lapse'] += float(match.group(1))
+            continue
+        match = __RPC__.match(line)
+        if match:
+            totals['rpc'] += float(match.group(1)) + float(match.group(2))
+            continue
+        match = __LOCKS__.match(line)
+        if match:
+            read_wait, read_held, write_wait, write_held = [int(group) for group in match.groups()]
+            totals['lock_wait'] += read_wait + write_wait
+            totals['lock_held'] += read_held + write_held
+            continue
+        match = __PAGES__.match(line)
+        if match:
+            totals['db_pages'] += int(match.group(1)) + int(match.group(2))
+    return totals
+
+
+def command_name(args):
+    """Get the p4 command name from the arguments to P4.run"""
+    while args and isinstance(args[0], (list, tuple)):
+        args = args[0]
+    return str(args[0]) if args else ''
+
+
+class ServerTracking:
+    """Aggregate server performance tracking per command type"""
+    def __init__(self):
+        self.commands = {}
+        self._lock = threading.Lock()
+
+    def add(self, command, track_output):
+        """Add tracking output for one run of a command"""
+        totals = parse_track_output(track_output)
+        with self._lock:
+            aggregate = self.commands.setdefault(command, dict.fromkeys(['count'] + __FIELDS__, 0))
+            aggregate['count'] += 1
+            for field in __FIELDS__:
+                aggregate[field] += totals[field]
+
+    def reset(self):
+        """Forget all tracking collected so far"""
+        with self._lock:
+            self.commands = {}
+
+    def summary(self):
+        """Human readable aggregate, slowest commands first"""
+        with self._lock:
+            commands = sorted(self.commands.items(), key=lambda item: -item[1]['lapse'])
+        return ', '.join(
+            '%s x%d: lapse %.2fs rpc %.2fs lock wait %dms held %dms db pages %d' % (
+                command, aggregate['count'], aggregate['lapse'], aggregate['rpc'],
+                aggregate['lock_wait'], aggregate['lock_held'], aggregate['db_pages'])
+            for command, aggregate in commands)
+
+
+class TrackedP4(P4):
+    """P4 connection which reports performance tracking for every command it runs"""
+    def __init__(self, tracking, *args, **kwargs):
+        P4.__init__(self, *args, **kwargs)
+        # P4 restricts attribute assignment to its own settings
+        self.__dict__['tracking'] = tracking
+        self.track = 1 # Must be enabled before connecting
+
+    def run(self, *args, **kargs):
+        try:
+            return P4.run(self, *args, **kargs)
+        finally:
+            if self.track_output:
+                self.tracking.add(command_name(args), self.track_output)
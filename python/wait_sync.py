@@ -0,0 +1,35 @@
+"""
+Wait for paths to be synced into the workspace by a checkout with priority paths
+
+Used from build scripts via $PERFORCE_WAIT_SYNC, e.g.
+    $PERFORCE_WAIT_SYNC //depot/assets/...
+Without any paths, waits for the whole workspace.
+"""
+import os
+import sys
+import argparse
+
+from workspace import wait_ready
+
+
+def main():
+    """Wait for paths, exiting non-zero if they failed to sync"""
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', default=['//...'], help='Depot paths the build needs')
+    parser.add_argument('--root', default=os.environ.get('BUILDKITE_PLUGIN_PERFORCE_ROOT') or
+                        os.environ.get('BUILDKITE_BUILD_CHECKOUT_PATH'), help='Workspace root')
+    parser.add_argument('--timeout', type=float, help='Seconds to wait before giving up')
+    args = parser.parse_args()
+    if not args.root:
+        parser.error('--root is required when BUILDKITE_BUILD_CHECKOUT_PATH is not set')
+
+    try:
+        wait_ready(args.root, args.paths, timeout=args.timeout)
+    except Exception as ex: # pylint: disable=broad-except
+        print(ex, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,270 @@
+"""
+Coordinate use of a client workspace between jobs and background processes
+
+State lives next to the workspace root rather than inside it, so that
+`p4 clean` and clean checkouts can never remove a lock which is held.
+"""
+import os
+import re
+import sys
+import json
+import shutil
+import subprocess
+import hashlib
+import time
+
+if sys.platform == 'win32':
+    import msvcrt # pylint: disable=import-error
+else:
+    import fcntl # pylint: disable=import-error
+
+# Job markers older than this are assumed to belong to jobs which never ran their pre-exit hook
+__STALE_JOB_SECONDS__ = 24 * 60 * 60
+# Overlays of a shared workspace which have not been checked out for this long are removed
+__OVERLAY_MAX_AGE_SECONDS__ = 7 * 24 * 60 * 60
+
+
+def state_path(root, suffix):
+    """Path for coordination state belonging to a workspace root, e.g. builds/.pipeline.lock"""
+    root = os.path.abspath(root)
+    return os.path.join(os.path.dirname(root), '.%s.%s' % (os.path.basename(root), suffix))
+
+
+class WorkspaceLock:
+    """Exclusive inter-process lock on a workspace, held while its files are being changed"""
+    def __init__(self, root):
+        self.path = state_path(root, 'lock')
+        self.handle = None
+
+    def acquire(self, blocking=True):
+        """Take the lock, returns False if blocking is disabled and the lock is held elsewhere"""
+        if self.handle is not None:
+            return True
+        parent = os.path.dirname(self.path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        handle = open(self.path, 'a+')
+        while True:
+            try:
+                if sys.platform == 'win32':
+                    handle.seek(0)
+                    msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                break
+            except OSError:
+                if not blocking:
+                    handle.close()
+                    return False
+                time.sleep(1) # msvcrt has no indefinitely blocking lock
+        self.handle = handle
+        return True
+
+    def release(self):
+        """Release the lock if it is held"""
+        if self.handle is None:
+            return
+        if sys.platform == 'win32':
+            self.handle.seek(0)
+            msvcrt.locking(self.handle.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+        self.handle.close()
+        self.handle = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class WorkspaceBusy(Exception):
+    """Other jobs are still using a shared workspace which needs to change"""
+
+
+def mark_job(root, job_id):
+    """Record that a job is using the workspace until its pre-exit hook runs"""
+    jobs_dir = state_path(root, 'jobs')
+    if not os.path.exists(jobs_dir):
+        os.makedirs(jobs_dir)
+    with open(os.path.join(jobs_dir, job_id), 'w') as outfile:
+        json.dump({'pid': os.getpid(), 'time': time.time()}, outfile)
+
+
+def clear_job(root, job_id):
+    """Remove the record of a job using the workspace"""
+    marker = os.path.join(state_path(root, 'jobs'), job_id)
+    if os.path.exists(marker):
+        os.remove(marker)
+
+
+def active_jobs(root, stale_after=__STALE_JOB_SECONDS__):
+    """Get ids of jobs currently using the workspace"""
+    jobs_dir = state_path(root, 'jobs')
+    if not os.path.isdir(jobs_dir):
+        return []
+    now = time.time()
+    jobs = []
+    for job_id in os.listdir(jobs_dir):
+        try:
+            if now - os.path.getmtime(os.path.join(jobs_dir, job_id)) < stale_after:
+                jobs.append(job_id)
+        except OSError:
+            pass # Job finished while listing
+    return jobs
+
+
+def save_settings(root, settings):
+    """Record how the last checkout set up the workspace, for background processes acting on it"""
+    path = state_path(root, 'settings.json')
+    with open('%s.tmp' % path, 'w') as outfile:
+        json.dump(settings, outfile)
+    os.replace('%s.tmp' % path, path)
+
+
+def load_settings(root):
+    """Get the settings recorded by save_settings, or None if the workspace has none"""
+    try:
+        with open(state_path(root, 'settings.json')) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+
+def wait_exclusive(root, job_id=None, timeout=60, poll=5):
+    """Wait for jobs other than job_id to finish using the workspace
+
+    Call while holding the WorkspaceLock, so that no new jobs start using it.
+    Returns False if other jobs are still using the workspace after timeout seconds.
+    """
+    deadline = time.time() + timeout
+    while True:
+        others = [other for other in active_jobs(root) if other != job_id]
+        if not others:
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(poll)
+
+
+def seed_overlay(root, name):
+    """Get the path of a private workspace next to a shared one, e.g. for one agent
+
+    A new overlay starts as a copy of the shared workspace where the filesystem supports
+    copy-on-write (e.g. btrfs or XFS), and otherwise starts empty. Call while holding the
+    WorkspaceLock of the shared workspace.
+    """
+    overlay = state_path(root, 'overlay-%s' % re.sub(r'\W', '-', name))
+    if os.path.exists(overlay) or not os.path.isdir(root) or not sys.platform.startswith('linux'):
+        return overlay
+    if subprocess.call(['cp', '-a', '--reflink=always', root, overlay]) != 0:
+        shutil.rmtree(overlay, ignore_errors=True) # A full copy would cost more than syncing
+    return overlay
+
+
+def prune_overlays(root, max_age=__OVERLAY_MAX_AGE_SECONDS__):
+    """Remove overlays of a shared workspace which no job has checked out for max_age seconds"""
+    root = os.path.abspath(root)
+    prefix = '.%s.overlay-' % os.path.basename(root)
+    now = time.time()
+    for name in os.listdir(os.path.dirname(root)):
+        overlay = os.path.join(os.path.dirname(root), name)
+        if not name.startswith(prefix) or not os.path.isdir(overlay) or active_jobs(overlay):
+            continue
+        p4config = os.path.join(overlay, 'p4config') # Rewritten by every checkout
+        last_used = os.path.getmtime(p4config if os.path.exists(p4config) else overlay)
+        if now - last_used < max_age:
+            continue
+        lock = WorkspaceLock(overlay)
+        if not lock.acquire(blocking=False):
+            continue # Being checked out
+        try:
+            shutil.rmtree(overlay, ignore_errors=True)
+        finally:
+            lock.release()
+
+
+def _ready_dir(root):
+    return state_path(root, 'ready')
+
+
+def mark_ready(root, path, error=None):
+    """Record that a sync path has landed in the workspace, or that syncing it failed"""
+    ready_dir = _ready_dir(root)
+    if not os.path.exists(ready_dir):
+        os.makedirs(ready_dir)
+    marker = os.path.join(ready_dir, hashlib.sha1(path.encode('utf-8')).hexdigest())
+    with open(marker + '.tmp', 'w') as outfile:
+        json.dump({'path': path, 'error': error, 'time': time.time()}, outfile)
+    os.replace(marker + '.tmp', marker)
+
+
+def clear_ready(root):
+    """Remove readiness markers before the workspace starts changing"""
+    ready_dir = _ready_dir(root)
+    if not os.path.isdir(ready_dir):
+        return
+    for name in os.listdir(ready_dir):
+        try:
+            os.remove(os.path.join(ready_dir, name))
+        except OSError:
+            pass # Removed by a concurrent clear
+
+
+def ready_paths(root):
+    """Get {path: error} for paths marked ready, error is None unless syncing the path failed"""
+    ready_dir = _ready_dir(root)
+    if not os.path.isdir(ready_dir):
+        return {}
+    paths = {}
+    for name in os.listdir(ready_dir):
+        if name.endswith('.tmp'):
+            continue
+        try:
+            with open(os.path.join(ready_dir, name)) as infile:
+                marker = json.load(infile)
+        except (OSError, ValueError):
+            continue # Cleared while reading
+        paths[marker['path']] = marker['error']
+    return paths
+
+
+def path_covers(synced, path):
+    """Whether syncing depot path 'synced' also syncs 'path', e.g. //depot/... covers //depot/tools/..."""
+    if synced.endswith('...'):
+        return path.startswith(synced[:-len('...')])
+    return synced == path
+
+
+def wait_ready(root, paths, timeout=None, poll=1):
+    """Block until every path has been synced into the workspace
+
+    Raises if syncing failed, or if the paths are not ready within timeout seconds.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+        ready = ready_paths(root)
+        errors = [error for error in ready.values() if error]
+        if errors:
+            raise Exception("Sync failed: %s" % errors[0])
+        waiting = [path for path in paths if not any(path_covers(synced, path) for synced in ready)]
+        if not waiting:
+            return
+        if deadline is not None and time.time() >= deadline:
+            raise Exception("Timed out waiting for %s to sync" % ', '.join(waiting))
+        time.sleep(poll)
+
+
+def start_background_sync(root, revision):
+    """Sync the rest of the workspace at root in a detached process, which waits for the checkout to release the lock"""
+    log = open(state_path(root, 'sync.log'), 'w')
+    if sys.platform == 'win32':
+        detach = {'creationflags': subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+    else:
+        detach = {'start_new_session': True}
+    checkout = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'checkout.py')
+    subprocess.Popen([sys.executable, checkout, '--finish-sync', revision, '--root', root],
+                     stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, **detach)
+    log.close()